@@ -0,0 +1,2351 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import errno
+import io
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from itertools import chain, islice
+from operator import itemgetter
+from stat import S_IFDIR, S_IFREG, S_ISDIR, S_ISREG
+
+JOBS = os.cpu_count() or 1
+DATE_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'format', 'dates.sqlite')
+DATE_CACHE_SIZE = 1000000
+DIR_STATE_PATH = os.path.join(os.path.dirname(DATE_CACHE_PATH), 'dirs.sqlite')
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'heic', 'heif', 'tif', 'tiff',
+                    'dng', 'cr2', 'cr3', 'nef', 'arw', 'raf', 'orf', 'rw2',
+                    'mov', 'mp4']
+SIDECAR_EXTENSIONS = ['pp3', 'xmp', 'aae', 'json', 'thm']
+TRANSFORM_CACHE_SIZE = 65536
+JOURNAL_SYNC_SIZE = 1000
+JOURNAL_SYNC_SECONDS = 1.0
+TARGETS_CHUNK_SIZE = 10000
+PLAN_VERSION = 1
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# What to do with an item whose new name is taken: keep everything in place,
+# keep only that item (and its sidecars) in place, or append _N to its name.
+# Only abort plans the whole tree first; otherwise each directory is checked
+# just before it is renamed and its conflicts are reported afterwards.
+CONFLICT_POLICIES = ['abort', 'skip', 'suffix']
+WATCH_DEBOUNCE_SECONDS = 0.5
+WATCH_MAX_DELAY_SECONDS = 5.0
+WATCH_RECENT_SIZE = 10000
+STATS = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+_RENAMEAT2 = None
+
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+EXIF_IFD_POINTER = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+TIFF_HEADER_SIZE = 64 * 1024
+JPEG_SOI = b'\xff\xd8'
+TIFF_MAGICS = (b'II*\x00', b'MM\x00*')
+PILLOW_MAGICS = (b'\x89PNG', b'RIFF')
+_USE_PILLOW = object()
+
+
+# A rename within one directory. Besides both paths, a move carries that
+# directory and both names, so the planner never splits a path again;
+# plan_renames fills them in for moves built from paths alone.
+Move = namedtuple('Move', ['src', 'dest', 'kind', 'group', 'directory',
+                           'name', 'new_name'],
+                  defaults=[None, None, None, None])
+# Everything that decides what a run does. Relative targets are resolved
+# against cwd, or the current directory when it is empty; date_cache is the
+# path of the capture date cache, if any; output is one of OUTPUTS and
+# on_conflict one of CONFLICT_POLICIES.
+Options = namedtuple('Options', [
+    'cwd', 'is_dry_run', 'is_to_lower', 'is_to_capitalize', 'is_recursive',
+    'is_file_only', 'exclude_dirs', 'substitute', 'name', 'jobs',
+    'date_cache', 'sidecar_extensions', 'output', 'on_conflict'],
+    defaults=['', False, False, False, False, False, (), '', '', JOBS, None,
+              tuple(SIDECAR_EXTENSIONS), 'none', 'skip'])
+Result = namedtuple('Result', ['renamed', 'errors'])
+
+
+def _move(directory, name, new_name, kind, group=None):
+    return Move(join(directory, name), join(directory, new_name), kind,
+                group, directory, name, new_name)
+
+
+def _with_names(move_):
+    directory, name = os.path.split(move_.src)
+    return move_._replace(directory=directory, name=name,
+                          new_name=basename(move_.dest))
+
+
+class MoveError(OSError):
+    move = None
+
+
+class Session:
+
+    # The mutable state of one run, so that runs with different options can
+    # go on side by side: the errors met so far and the directories they
+    # were met in, where the results go (stdout unless another text file is
+    # given), the date cache, plus the journal and incremental state of the
+    # CLI.
+    def __init__(self, options, journal=None, dir_state=None,
+                 skip_dirs=frozenset(), file=None):
+        self.options = options
+        self.output = OUTPUTS[options.output](file or sys.stdout,
+                                              options.is_dry_run)
+        self.journal = journal
+        self.dir_state = dir_state
+        self.skip_dirs = skip_dirs
+        self.errors = []
+        self.failed_dirs = set()
+        self._date_cache = None
+
+    @property
+    def date_cache(self):
+        # Opened on first use and kept until the run is closed, so old
+        # dates are evicted once per run
+        if self._date_cache is None and self.options.date_cache is not None:
+            self._date_cache = DateCache(self.options.date_cache,
+                                         DATE_CACHE_SIZE)
+        return self._date_cache
+
+    def close(self):
+        self.output.close()
+        if self._date_cache is not None:
+            self._date_cache.close()
+            self._date_cache = None
+
+
+class Stats:
+
+    # Time spent per phase and counts of the work done, collected with
+    # --stats. Counters may be bumped from the date reading threads.
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timers[name] = self.timers.get(name, 0.0) + elapsed
+
+    def report(self):
+        return {'timers': self.timers, 'counters': self.counters}
+
+    def print(self, file):
+        for name, seconds in self.timers.items():
+            print(f'{name:<16} {seconds:>12.3f}s', file=file)
+        for name, value in sorted(self.counters.items()):
+            print(f'{name:<16} {value:>12}', file=file)
+
+
+_NO_TIMER = nullcontext()
+
+
+def count(name, value=1):
+    if STATS is not None:
+        STATS.count(name, value)
+
+
+def timer(name):
+    return _NO_TIMER if STATS is None else STATS.timer(name)
+
+
+def _timed(iterable, name):
+    # Charges the time spent producing each item to the given timer
+    iterator = iter(iterable)
+    while True:
+        with timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _parse_exif_date(value):
+    from datetime import datetime
+    try:
+        return datetime.strptime(value.rstrip('\x00 '), EXIF_DATE_FORMAT)
+    except ValueError:
+        return None
+
+
+def _find_ifd_entry(tiff, endian, offset, tag):
+    if offset + 2 > len(tiff):
+        return _USE_PILLOW
+    count, = struct.unpack_from(f'{endian}H', tiff, offset)
+    for index in range(count):
+        entry = offset + 2 + 12 * index
+        if entry + 12 > len(tiff):
+            return _USE_PILLOW
+        if struct.unpack_from(f'{endian}H', tiff, entry)[0] == tag:
+            return struct.unpack_from(f'{endian}HI4s', tiff, entry + 2)
+    return None
+
+
+def _read_tiff_date(tiff):
+    if tiff[:4] not in TIFF_MAGICS:
+        return _USE_PILLOW
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd_offset, = struct.unpack_from(f'{endian}I', tiff, 4)
+    pointer = _find_ifd_entry(tiff, endian, ifd_offset, EXIF_IFD_POINTER)
+    if pointer is None or pointer is _USE_PILLOW:
+        return pointer
+    exif_offset, = struct.unpack(f'{endian}I', pointer[2])
+    entry = _find_ifd_entry(tiff, endian, exif_offset, DATE_TIME_ORIGINAL)
+    if entry is None or entry is _USE_PILLOW:
+        return entry
+    _, count, value = entry
+    if count > 4:
+        value_offset, = struct.unpack(f'{endian}I', value)
+        if value_offset + count > len(tiff):
+            return _USE_PILLOW
+        value = tiff[value_offset:value_offset + count]
+    return _parse_exif_date(value[:count].decode('ascii', 'replace'))
+
+
+def _read_jpeg_date(file):
+    file.seek(len(JPEG_SOI))
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return _USE_PILLOW
+        while marker[1] == 0xFF:
+            marker = marker[1:] + file.read(1)
+            if len(marker) < 2:
+                return _USE_PILLOW
+        code = marker[1]
+        # Start of scan or end of image: no EXIF segment up front
+        if code in (0xDA, 0xD9):
+            return None
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length = file.read(2)
+        if len(length) < 2:
+            return _USE_PILLOW
+        size = struct.unpack('>H', length)[0] - 2
+        if code != 0xE1:
+            file.seek(size, os.SEEK_CUR)
+            continue
+        segment = file.read(size)
+        if segment.startswith(b'Exif\x00\x00'):
+            return _read_tiff_date(segment[6:])
+
+
+def read_exif_date(path):
+    # Reads DateTimeOriginal straight from the JPEG/TIFF headers. Returns
+    # None when the file has no such tag or is not an image at all, and
+    # _USE_PILLOW for image files this parser does not understand.
+    try:
+        with FS.open(path) as file:
+            magic = file.read(4)
+            if magic.startswith(JPEG_SOI):
+                return _read_jpeg_date(file)
+            if magic in TIFF_MAGICS:
+                return _read_tiff_date(magic + file.read(TIFF_HEADER_SIZE))
+    except (OSError, struct.error):
+        return _USE_PILLOW
+    if magic in PILLOW_MAGICS:
+        return _USE_PILLOW
+    return None
+
+
+def _read_exif_date_with_pillow(path):
+    # Pillow takes longer to import than most runs take otherwise
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with FS.open(path) as file, Image.open(file) as image:
+            exif = image.getexif().get_ifd(EXIF_IFD_POINTER)
+            return _parse_exif_date(str(exif[DATE_TIME_ORIGINAL]))
+    except (UnidentifiedImageError, OSError, TypeError, KeyError):
+        return None
+
+
+def get_date_taken(path, stat=None):
+    from datetime import datetime
+    count('exif_reads')
+    date = read_exif_date(path)
+    if date is _USE_PILLOW:
+        count('pillow_reads')
+        date = _read_exif_date_with_pillow(path)
+    if date is not None:
+        return date
+    if stat is None:
+        count('stats')
+        stat = FS.stat(path)
+    try:
+        return datetime.fromtimestamp(stat.st_birthtime)
+    except AttributeError:
+        return datetime.fromtimestamp(stat.st_mtime)
+
+
+class DateCache:
+
+    def __init__(self, path, size):
+        self._size = size
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS dates ('
+                         'key BLOB PRIMARY KEY, date TEXT, used INTEGER)'
+                         ' WITHOUT ROWID')
+        self._used = int(time.time())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @staticmethod
+    def key(stat):
+        return struct.pack('<QQQq', stat.st_dev, stat.st_ino, stat.st_size,
+                           stat.st_mtime_ns)
+
+    def get(self, keys):
+        from datetime import datetime
+        dates = []
+        hits = []
+        for key in keys:
+            row = self._db.execute('SELECT date FROM dates WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                dates.append(None)
+            else:
+                dates.append(datetime.fromisoformat(row[0]))
+                hits.append((self._used, key))
+        with self._db:
+            self._db.executemany('UPDATE dates SET used = ? WHERE key = ?',
+                                 hits)
+        return dates
+
+    def put(self, keys, dates):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO dates VALUES (?, ?, ?)',
+                [(key, date.isoformat(), self._used)
+                 for key, date in zip(keys, dates)])
+
+    def close(self):
+        # Evict the least recently used dates once the cache is over size
+        with self._db:
+            excess = self._db.execute(
+                'SELECT COUNT(*) FROM dates').fetchone()[0] - self._size
+            if excess > 0:
+                self._db.execute('DELETE FROM dates WHERE key IN (SELECT key'
+                                 ' FROM dates ORDER BY used LIMIT ?)',
+                                 (excess,))
+        self._db.close()
+
+
+def dirname(path):
+    return os.path.dirname(path)
+
+
+def basename(path):
+    return os.path.basename(path)
+
+
+def join(root, relative_path):
+    return os.path.join(root, relative_path)
+
+
+_WORD = re.compile(r'\S+')
+
+
+def _capitalize_words(name):
+    return _WORD.sub(lambda word: word.group().capitalize(),
+                     name.replace('_', ' '))
+
+
+def _replace(old, new):
+    return lambda name: name.replace(old, new)
+
+
+@lru_cache(maxsize=8)
+def compile_transform(is_to_lower, is_to_capitalize, substitute):
+    # Builds the rule pipeline once per set of options; the returned
+    # function memoizes its results since the same names repeat a lot
+    rules = []
+    if is_to_lower:
+        rules.append(str.lower)
+    elif is_to_capitalize:
+        rules.append(_capitalize_words)
+    rules.append(_replace(' ', '_'))
+    rules.append(_replace('Of', 'of'))
+    if substitute:
+        rules.append(_replace(*substitute.split('/', maxsplit=1)))
+
+    @lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+    def transform(name):
+        for rule in rules:
+            name = rule(name)
+        return name
+
+    return transform
+
+
+class Rename:
+
+    def __init__(self, options):
+        self._counter = 1
+        self._last_dir = ''
+        self._options = options
+        self._transform = compile_transform(
+            options.is_to_lower, options.is_to_capitalize, options.substitute)
+
+    def run(self, path, is_file_):
+        dir_name, name = os.path.split(join(self._options.cwd, path))
+        return join(dir_name, self.new_name(dir_name, name, is_file_))
+
+    def new_name(self, dir_name, name, is_file_):
+        options = self._options
+        if options.name and options.is_recursive:
+            raise RuntimeError(
+                'Do not use the recursive option when renaming  batch files')
+
+        if options.name and is_file_:
+            if self._last_dir != dir_name:
+                self._counter = 1
+            if '.' in name:
+                extension = get_extension(name)
+                tmp = f'{options.name}_{self._counter}.{extension}'
+            else:
+                tmp = f'{options.name}_{self._counter}'
+            self._counter += 1
+            self._last_dir = dir_name
+            return tmp
+
+        return self._transform(name)
+
+    def sidecar_suffix(self, suffix):
+        # What follows the name of the file a sidecar belongs to, as .XMP
+        # or .JPG.pp3, gets the same rules as that file's extension; only
+        # numbered names keep it as it is
+        if self._options.name:
+            return suffix
+        return self._transform(suffix)
+
+    def reset(self):
+        self._counter = 1
+
+
+def main():
+    global STATS
+
+    parser = argparse.ArgumentParser(description='Reformat file names')
+    parser.add_argument('targets', nargs='*', help='Targets to rename')
+    parser.add_argument('-d', '--dry-run', action='store_true',
+                        help='Only show what it would do.')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Apply reformatting recursively')
+    parser.add_argument('-l', '--lower', action='store_true',
+                        help='Change to all lower case')
+    parser.add_argument('-c', '--capitalize', action='store_true',
+                        help='Capitalize first letter of each word')
+    parser.add_argument('-f', '--files', action='store_true',
+                        help='Change files only, ignore dirs')
+    parser.add_argument('-e', '--exclude_dirs', nargs=1, default=[],
+                        help='Exclude the directories that match')
+    parser.add_argument('-s', '--substitute', nargs=1,
+                        help='Substitute with matching sequence')
+    parser.add_argument('-n', '--name', nargs=1,
+                        help='Rename appending a numeric sequence')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='Number of files to read dates from, and of'
+                        ' directories to rename, in parallel (default:'
+                        f' {JOBS})')
+    parser.add_argument('--sidecars', default=','.join(SIDECAR_EXTENSIONS),
+                        help='Comma separated extensions of companion files'
+                        ' renamed along with their image (default:'
+                        ' %(default)s)')
+    parser.add_argument('--cache', action='store_true',
+                        help='Remember capture dates between runs in'
+                        f' {DATE_CACHE_PATH}')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Skip directories unchanged since the last run'
+                        f' (state kept in {DIR_STATE_PATH})')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running and format new entries as they'
+                        ' arrive in the target directories (Linux only)')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Log every rename to FILE so an interrupted run'
+                        ' can be resumed or undone')
+    parser.add_argument('--resume', action='store_true',
+                        help='Finish the renames left over in the journal and'
+                        ' continue, skipping completed directories')
+    parser.add_argument('--undo', action='store_true',
+                        help='Revert the renames recorded in the journal')
+    # The list is opened while the arguments are parsed, so a missing
+    # file is reported before anything is renamed
+    parser.add_argument('--from-file', metavar='FILE',
+                        type=argparse.FileType('rb'),
+                        help='Also rename the targets listed in FILE, one'
+                        ' per line ("-" reads them from stdin)')
+    parser.add_argument('--stdin', action='store_const',
+                        const=sys.stdin.buffer, dest='from_file',
+                        help='Same as --from-file -')
+    parser.add_argument('-0', '--null', action='store_true',
+                        help='Targets in the list are separated by NUL'
+                        ' characters, as printed by find -print0')
+    parser.add_argument('--plan-out', metavar='FILE',
+                        help='Save what a dry run would do to FILE, to be'
+                        ' applied later by --apply-plan')
+    parser.add_argument('--apply-plan', metavar='FILE',
+                        help='Apply the renames saved in FILE, unless any of'
+                        ' their items changed in the meantime; exits with'
+                        ' status 1 when nothing could be applied')
+    parser.add_argument('--on-conflict', choices=CONFLICT_POLICIES,
+                        default='skip',
+                        help='When a new name is taken, rename nothing at'
+                        ' all, leave that item alone, or append _N to it.'
+                        ' Only abort checks the whole tree before the first'
+                        ' rename; the others check each directory before'
+                        ' renaming it (default: %(default)s)')
+    parser.add_argument('-o', '--output', choices=sorted(OUTPUTS),
+                        default='text',
+                        help='How to report the results: text lines, a JSON'
+                        ' object or tab separated status, kind, src and dest'
+                        ' per item followed by a summary, or nothing'
+                        ' (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent per phase and counts of'
+                        ' the work done to stderr')
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help='Write the same statistics as JSON to FILE')
+
+    args = parser.parse_args()
+    if (args.resume or args.undo) and not args.journal:
+        parser.error('--resume and --undo require --journal')
+    if (args.resume or args.undo) and \
+            (args.dry_run or args.plan_out is not None):
+        parser.error('--resume and --undo cannot be used with --dry-run or'
+                     ' --plan-out')
+    if args.apply_plan is not None:
+        if args.targets or args.from_file is not None or args.watch or \
+                args.plan_out is not None:
+            parser.error('--apply-plan takes no targets and cannot be used'
+                         ' with --watch or --plan-out')
+    elif not args.targets and not args.undo and args.from_file is None:
+        parser.error('the following arguments are required: targets')
+    if args.watch and args.plan_out is not None:
+        parser.error('--plan-out cannot be used with --watch')
+    if args.watch and args.from_file is not None:
+        parser.error('--from-file and --stdin cannot be used with --watch')
+    if args.watch and args.name:
+        parser.error('--name cannot be used with --watch')
+
+    options = Options(
+        cwd=os.getcwd(),
+        is_dry_run=args.dry_run or args.plan_out is not None,
+        is_to_lower=args.lower,
+        is_to_capitalize=args.capitalize,
+        is_recursive=args.recursive,
+        is_file_only=args.files,
+        exclude_dirs=tuple(args.exclude_dirs),
+        substitute=args.substitute[0] if args.substitute else '',
+        name=args.name[0] if args.name else '',
+        jobs=max(1, args.jobs),
+        date_cache=DATE_CACHE_PATH if args.cache else None,
+        sidecar_extensions=tuple(extension.strip('.').lower() for extension
+                                 in args.sidecars.split(',') if extension),
+        output=args.output, on_conflict=args.on_conflict)
+    # Results are written in large blocks, or line by line to a terminal
+    session = Session(options, file=open(
+        sys.stdout.fileno(), 'w',
+        buffering=1 if sys.stdout.isatty() else OUTPUT_BUFFER_SIZE,
+        encoding=sys.stdout.encoding, errors='surrogateescape',
+        closefd=False))
+
+    if args.incremental and not options.is_dry_run:
+        session.dir_state = DirState(DIR_STATE_PATH, json.dumps([
+            options.is_to_lower, options.is_to_capitalize,
+            options.substitute, options.name, options.is_file_only,
+            options.exclude_dirs, options.sidecar_extensions]))
+    if args.stats or args.stats_json:
+        STATS = Stats()
+    is_success = False
+    try:
+        with timer('total'):
+            status = run(args, session)
+        is_success = True
+    finally:
+        session.close()
+        if session.dir_state is not None:
+            session.dir_state.close(commit=is_success)
+        if STATS is not None:
+            write_stats(args)
+    return status
+
+
+def write_stats(args):
+    if args.stats:
+        STATS.print(sys.stderr)
+    if args.stats_json:
+        with open(args.stats_json, 'w', encoding='utf-8') as file:
+            json.dump(STATS.report(), file, indent=2)
+
+
+def run(args, session):
+    start = watch if args.watch else process
+    if args.plan_out is not None:
+        start = partial(export_plan, path=args.plan_out)
+    elif args.apply_plan is not None:
+        start = partial(apply_saved_plan, path=args.apply_plan)
+    targets = args.targets
+    if args.from_file is not None:
+        targets = chain(targets, list_targets(args.from_file,
+                                              b'\0' if args.null else b'\n'))
+    if args.journal is None or session.options.is_dry_run:
+        return start(targets, session)
+    session.journal = Journal(args.journal)
+    try:
+        if args.undo:
+            if undo_journal(session.journal, session.output) == 0:
+                session.output.message('Nothing to undo.')
+            return None
+        if args.resume:
+            resume_journal(session.journal, session.output)
+            session.skip_dirs = frozenset(session.journal.state.finished)
+        return start(targets, session)
+    finally:
+        session.journal.close()
+
+
+def list_targets(file, separator):
+    # Yields the targets listed in a binary file as they are read, so lists
+    # of any length go through a single run
+    with file:
+        rest = b''
+        for block in iter(lambda: file.read(64 * 1024), b''):
+            targets = (rest + block).split(separator)
+            rest = targets.pop()
+            for target in targets:
+                if target:
+                    yield os.fsdecode(target)
+        if rest:
+            yield os.fsdecode(rest)
+
+
+def plan(targets, options):
+    # Works out every rename up front without touching anything: a plan
+    # for the files and one for the subdirectories of each directory, in
+    # the order apply() must follow.
+    session = Session(options)
+    try:
+        return TreePlan(options, _plan_batches(
+            find_batches(targets, session), session))
+    finally:
+        session.close()
+
+
+def _plan_batches(batches, session):
+    options = session.options
+    planned = []
+    for root, dirs, files, index in batches:
+        count('files', len(files))
+        count('dirs', len(dirs))
+        sort_files(files, options, session)
+        with timer('plan'):
+            files_plan = plan_renames(file_moves(files, index, options),
+                                      index=index,
+                                      policy=options.on_conflict)
+            dirs_plan = Plan()
+            if not options.is_file_only:
+                # The files will have their new names by then
+                index.rename(files_plan.moves)
+                dirs_plan = plan_renames(dir_moves(dirs, options),
+                                         index=index,
+                                         policy=options.on_conflict)
+        planned.append((root, dirs, files_plan, dirs_plan))
+    if options.on_conflict == 'abort':
+        _hold([plan_ for _, _, files_plan, dirs_plan in planned
+               for plan_ in (files_plan, dirs_plan)])
+    return planned
+
+
+def apply(tree_plan, file=None):
+    session = Session(tree_plan.options, file=file)
+    renamed = []
+    try:
+        _apply_tree(tree_plan, session, renamed)
+    finally:
+        session.close()
+    return Result(renamed, session.errors)
+
+
+def _apply_tree(tree_plan, session, renamed=None):
+    # Nothing is renamed if any source changed since the plan was made
+    if tree_plan.guards is not None:
+        stale = _stale_sources(tree_plan)
+        if stale:
+            session.errors.extend(stale)
+            for error in stale:
+                session.output.failed(error.move, error, 'failed')
+            return 0
+    return _apply_batches(tree_plan.batches, session, renamed)
+
+
+def _stale_sources(tree_plan):
+    stale = []
+    count('stats', len(tree_plan.guards))
+    for move_ in tree_plan.moves:
+        try:
+            stat = FS.lstat(move_.src)
+        except OSError:
+            stat = None
+        if stat is None or \
+                (stat.st_ino, stat.st_mtime_ns) != tree_plan.guards[move_.src]:
+            error = MoveError(errno.ESTALE, 'Changed since the plan was made',
+                              move_.src, None, move_.dest)
+            error.move = move_
+            stale.append(error)
+    return stale
+
+
+def write_plan(tree_plan, path):
+    # One JSON array per line: a version header, then every batch ('B')
+    # followed by the moves of its files ('f') and subdirectories ('d').
+    # Sources carry their inode and mtime; destinations are in the same
+    # directory, so only their names are kept.
+    with open(path, 'w', encoding='utf-8', errors='surrogateescape') as file:
+        file.write(json.dumps(['V', PLAN_VERSION]) + '\n')
+        for root, dirs, files_plan, dirs_plan in tree_plan.batches:
+            file.write(json.dumps(['B', root, dirs]) + '\n')
+            for record_type, plan_ in (('f', files_plan), ('d', dirs_plan)):
+                for move_ in plan_.moves:
+                    stat = FS.lstat(move_.src)
+                    file.write(json.dumps([
+                        record_type, move_.src, move_.new_name,
+                        move_.kind, move_.group, stat.st_ino,
+                        stat.st_mtime_ns]) + '\n')
+
+
+# Fields per record type, the type included
+PLAN_RECORD_SIZES = {'B': 3, 'f': 7, 'd': 7}
+
+
+def read_plan(path, options):
+    batches = []
+    guards = {}
+    with open(path, encoding='utf-8', errors='surrogateescape') as file:
+        if json.loads(file.readline() or 'null') != ['V', PLAN_VERSION]:
+            raise ValueError(f'{path}: not a rename plan')
+        for number, line in enumerate(file, start=2):
+            record = json.loads(line)
+            error = _plan_record_error(record, bool(batches))
+            if error is not None:
+                raise ValueError(f'{path}:{number}: {error}')
+            if record[0] == 'B':
+                moves = {'f': [], 'd': []}
+                batches.append((record[1], record[2], moves))
+                continue
+            src, name, kind, group, inode, mtime = record[1:]
+            directory, old_name = os.path.split(src)
+            moves[record[0]].append(Move(src, join(directory, name), kind,
+                                         group, directory, old_name, name))
+            guards[src] = (inode, mtime)
+    return TreePlan(options, [
+        (root, dirs, _planned(moves['f']), _planned(moves['d']))
+        for root, dirs, moves in batches], guards)
+
+
+def _plan_record_error(record, in_batch):
+    if not isinstance(record, list) or not record:
+        return 'not a plan record'
+    if not isinstance(record[0], str) or record[0] not in PLAN_RECORD_SIZES:
+        return f'unknown record type {record[0]!r}'
+    size = PLAN_RECORD_SIZES[record[0]]
+    if len(record) != size:
+        return f"'{record[0]}' record with {len(record)} fields, not {size}"
+    if record[0] == 'B':
+        # Batches of explicit targets have no root
+        _, root, dirs = record
+        if not (root is None or isinstance(root, str)) or \
+                not isinstance(dirs, list) or \
+                not all(isinstance(path, str) for path in dirs):
+            return "'B' record without a root path and a list of paths"
+        return None
+    if not in_batch:
+        return 'move before any batch'
+    _, src, name, kind, group, inode, mtime = record
+    if not all(isinstance(field, str) for field in (src, name, kind)) or \
+            not (group is None or isinstance(group, str)) or \
+            not all(isinstance(field, int) for field in (inode, mtime)):
+        return f"'{record[0]}' record with fields of the wrong type"
+    return None
+
+
+def _planned(moves):
+    plan_ = Plan()
+    plan_.moves = moves
+    plan_.steps = _order_steps(moves)
+    return plan_
+
+
+def dir_moves(dirs, options):
+    rename = Rename(options)
+    # Children must be renamed before their parents, and siblings are kept
+    # together so the planner can order renames within each directory.
+    # The paths of dirs are absolute, as found by the walk.
+    dirs.sort(key=lambda path: -path.count(os.sep))
+    moves = []
+    for path in dirs:
+        directory, name = os.path.split(path)
+        moves.append(_move(directory, name,
+                           rename.new_name(directory, name, is_file_=False),
+                           'dir'))
+    return moves
+
+
+def _read_dates_taken(files, stats, jobs):
+    if jobs == 1 or len(files) < 2:
+        return list(map(get_date_taken, files, stats))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(get_date_taken, files, stats))
+
+
+def get_dates_taken(files, options, cache=None):
+    # A run passes the cache its session keeps open; otherwise one is
+    # opened for this call alone
+    with timer('dates'):
+        if cache is not None or options.date_cache is None:
+            return _get_dates_taken(files, options, cache)
+        with DateCache(options.date_cache, DATE_CACHE_SIZE) as cache:
+            return _get_dates_taken(files, options, cache)
+
+
+def _get_dates_taken(files, options, cache):
+    if cache is None:
+        return _read_dates_taken(files, [None] * len(files), options.jobs)
+    # One stat per file; only files the cache does not know are read
+    count('stats', len(files))
+    stats = [FS.stat(path) for path in files]
+    keys = [DateCache.key(stat) for stat in stats]
+    dates = cache.get(keys)
+    misses = [index for index, date in enumerate(dates) if date is None]
+    count('cache_hits', len(files) - len(misses))
+    count('cache_misses', len(misses))
+    read = _read_dates_taken([files[index] for index in misses],
+                             [stats[index] for index in misses],
+                             options.jobs)
+    cache.put([keys[index] for index in misses], read)
+    for index, date in zip(misses, read):
+        dates[index] = date
+    return dates
+
+
+def sort_files(files, options, session=None):
+    # Only numbered names depend on the order of the files, and numbers
+    # start over in every directory: files are grouped by directory, in
+    # the order the directories first appear, and each group is sorted by
+    # the dates read once per file.
+    if not options.name:
+        return
+    cache = None if session is None else session.date_cache
+    with timer('sort'):
+        dates = get_dates_taken([entry.path for entry in files], options,
+                                cache)
+        groups = {}
+        for entry, date in zip(files, dates):
+            groups.setdefault(entry.directory, []).append((date, entry))
+        files[:] = [entry for group in groups.values()
+                    for _, entry in sorted(group, key=itemgetter(0))]
+
+
+def is_image(path):
+    extension = get_extension(path)
+    if extension is not None and extension in IMAGE_EXTENSIONS:
+        return True
+    return False
+
+
+def find_sidecars(name, names, extensions):
+    # Companions are either the whole name plus an extension, as in
+    # IMG_1.JPG.pp3, or the name with its extension swapped, as in IMG_1.xmp
+    stem = os.path.splitext(name)[0]
+    sidecars = []
+    for extension in extensions:
+        for prefix in (name, stem):
+            sidecar = names.get(f'{prefix}.{extension}'.lower())
+            if sidecar is not None:
+                sidecars.append((sidecar, len(prefix)))
+                break
+    return sidecars
+
+
+def file_moves(files, index, options):
+    rename = Rename(options)
+    moves = []
+
+    groups = {}
+    claimed = set()
+    # Sidecars are claimed by (directory, name), and full paths are only
+    # joined for the moves themselves
+    for entry in files:
+        directory, name = entry.directory, entry.name
+        if (directory, name) in claimed or not is_image(name):
+            continue
+        sidecars = [(sidecar, length) for sidecar, length
+                    in find_sidecars(name, index.names(directory),
+                                     options.sidecar_extensions)
+                    if (directory, sidecar) not in claimed]
+        if sidecars:
+            groups[entry] = sidecars
+            claimed.update((directory, sidecar) for sidecar, _ in sidecars)
+
+    for entry in files:
+        directory, name = entry.directory, entry.name
+        if (directory, name) in claimed:
+            continue
+        new_name = rename.new_name(directory, name, is_file_=True)
+        sidecars = groups.get(entry, [])
+        src = join(directory, name)
+        group = src if sidecars else None
+        moves.append(Move(src, join(directory, new_name), 'file', group,
+                          directory, name, new_name))
+
+        new_stem = os.path.splitext(new_name)[0]
+        for sidecar, length in sidecars:
+            prefix = new_name if length == len(name) else new_stem
+            suffix = rename.sidecar_suffix(sidecar[length:])
+            moves.append(_move(directory, sidecar, prefix + suffix,
+                               'sidecar', group))
+
+    return moves
+
+
+def process(targets, session):
+
+    if session.options.is_dry_run:
+        session.output.message('DRY-RUN\n')
+
+    if rename_batches(find_batches(targets, session), session) > 0:
+        return
+    if session.options.on_conflict == 'abort' and \
+            session.output.counts['conflict'] > 0:
+        session.output.message('Nothing renamed: there are conflicts.')
+    else:
+        session.output.message('Not items found that need formatting.')
+
+
+def export_plan(targets, session, path):
+    options = session.options
+    session.output.message('DRY-RUN\n')
+    batches = find_batches(targets, session)
+    if STATS is not None:
+        batches = _timed(batches, 'discover')
+    tree_plan = TreePlan(options, _plan_batches(batches, session))
+    write_plan(tree_plan, path)
+    if _apply_batches(tree_plan.batches, session, None) == 0:
+        session.output.message('Not items found that need formatting.')
+
+
+def apply_saved_plan(_targets, session, path):
+    # Returns the exit status, which tells scripts when nothing was applied
+    try:
+        tree_plan = read_plan(path, session.options)
+    except (OSError, ValueError) as error:
+        print(f'format: cannot read plan: {error}', file=sys.stderr)
+        return 1
+    if session.options.is_dry_run:
+        session.output.message('DRY-RUN\n')
+    if _apply_tree(tree_plan, session) > 0:
+        return 0
+    if session.errors:
+        session.output.message('Nothing renamed: the plan is out of date.')
+        return 1
+    session.output.message('Not items found that need formatting.')
+    return 0
+
+
+def rename_batches(batches, session, renamed=None):
+    # Files are renamed before the directories holding them, so the paths
+    # found by the walk stay valid throughout. The applied moves are only
+    # collected when a renamed list is given. To abort on conflicts, the
+    # whole tree is planned before the first rename.
+    if STATS is not None:
+        batches = _timed(batches, 'discover')
+    if session.options.on_conflict == 'abort':
+        batches = _plan_batches(batches, session)
+    else:
+        batches = _plan_files(batches, session)
+    return _apply_batches(batches, session, renamed)
+
+
+def _plan_files(batches, session):
+    # Subdirectories are planned once their own batches have been applied
+    options = session.options
+    for root, dirs, files, index in batches:
+        count('files', len(files))
+        count('dirs', len(dirs))
+        sort_files(files, options, session)
+        with timer('plan'):
+            files_plan = plan_renames(file_moves(files, index, options),
+                                      index=index,
+                                      policy=options.on_conflict)
+        yield root, dirs, files_plan, None
+
+
+def _apply_batch(root, files_plan, dirs, dirs_plan, children, session):
+    files_failed = _apply(files_plan, session)
+    for child in children:
+        child.result()
+    if dirs_plan is None:
+        dirs_plan = Plan()
+        if not session.options.is_file_only:
+            with timer('plan'):
+                dirs_plan = plan_renames(
+                    dir_moves(dirs, session.options),
+                    policy=session.options.on_conflict)
+    dirs_failed = _apply(dirs_plan, session)
+    return files_failed, dirs_plan, dirs_failed, _root_stat(root, session)
+
+
+def _root_stat(root, session):
+    # Taken here, since the batch of the parent may rename root as soon as
+    # this one is done, before the main thread gets to finish it
+    if root is None or session.journal is None and session.dir_state is None:
+        return None
+    count('stats')
+    try:
+        return FS.stat(root)
+    except OSError:
+        return None
+
+
+class _Applied:
+
+    # Stands in for the future of a batch applied right away
+    def __init__(self, result):
+        self._result = result
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self._result
+
+
+class _BatchPool:
+
+    # Applies the batches of up to jobs directories at a time, which pays
+    # off where every rename is a round trip, as on network filesystems.
+    # Subdirectories are renamed only once every batch below them,
+    # submitted before by the bottom-up walk, is done: with dir_state, the
+    # batches of a directory that is not listed itself run under the
+    # parent's, so the wait covers all descendants and not just the
+    # children. Batches without a root hold explicit targets and wait for
+    # everything before them.
+    # Finished batches are handed back in the order they were submitted.
+    # The threads are only started for the second batch with work to do,
+    # which spares single renames their cost.
+    def __init__(self, session):
+        self._session = session
+        self._jobs = session.options.jobs
+        self._executor = None
+        self._has_work = False
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    def submit(self, root, dirs, files_plan, dirs_plan):
+        if root is None:
+            children = [batch[-1] for batch in self._pending] if dirs else []
+        else:
+            # Batches that were handed back already are done
+            prefixes = tuple(path + os.sep for path in dirs)
+            children = [future for path, _, _, future in self._pending
+                        if path is not None and (path in dirs or
+                                                 path.startswith(prefixes))]
+        args = (root, files_plan, dirs, dirs_plan, children, self._session)
+        has_work = bool(files_plan.steps or dirs)
+        if has_work and self._has_work and self._executor is None and \
+                self._jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self._jobs)
+        self._has_work = self._has_work or has_work
+        if has_work and self._executor is not None:
+            future = self._executor.submit(_apply_batch, *args)
+        else:
+            future = _Applied(_apply_batch(*args))
+        self._pending.append((root, dirs, files_plan, future))
+        return self._finished(2 * self._jobs)
+
+    def drain(self):
+        return self._finished(0)
+
+    def _finished(self, limit):
+        while self._pending and (len(self._pending) > limit or
+                                 self._pending[0][-1].done()):
+            root, dirs, files_plan, future = self._pending.popleft()
+            yield (root, dirs, files_plan, *future.result())
+
+
+def _apply_batches(batches, session, renamed):
+    rename_cnt = 0
+    with _BatchPool(session) as pool:
+        for batch in batches:
+            for finished in pool.submit(*batch):
+                rename_cnt += _finish_batch(*finished, session, renamed)
+        for finished in pool.drain():
+            rename_cnt += _finish_batch(*finished, session, renamed)
+    return rename_cnt
+
+
+def _finish_batch(root, dirs, files_plan, files_failed, dirs_plan,
+                  dirs_failed, root_stat, session, renamed):
+    renamed_files = _report(files_plan, files_failed, session)
+    renamed_dirs = _report(dirs_plan, dirs_failed, session)
+    if renamed is not None:
+        renamed.extend(renamed_files)
+        renamed.extend(renamed_dirs)
+    if root_stat is not None:
+        if session.journal is not None:
+            session.journal.finish(root_stat)
+        if session.dir_state is not None and \
+                root not in session.failed_dirs:
+            new_paths = {move_.src: move_.dest for move_ in renamed_dirs}
+            session.dir_state.record(root_stat,
+                                     [basename(new_paths.get(path, path))
+                                      for path in dirs])
+    return len(renamed_files) + len(renamed_dirs)
+
+
+def get_extension(path):
+    if '.' in path:
+        return path.rsplit('.', 1)[-1].lower()
+    return None
+
+
+def is_under_excluded_dirs(path, exclude_dirs):
+    return not exclude_dirs.isdisjoint(path.split(os.sep))
+
+
+def _scan_dir(path, exclude_dirs):
+    dirs = []
+    files = []
+    count('listings')
+    try:
+        with FS.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir_ = entry.is_dir()
+                except OSError:
+                    is_dir_ = False
+                if not is_dir_:
+                    files.append(entry)
+                elif entry.name not in exclude_dirs:
+                    dirs.append(entry)
+    except OSError:
+        pass
+    return dirs, files
+
+
+class DirState:
+
+    # Remembers, per directory inode, the mtime and subdirectory names seen
+    # after the last successful run with the same renaming rules. Changes
+    # are only committed once the whole run succeeded.
+    def __init__(self, path, rules):
+        self._rules = rules
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                         'key BLOB PRIMARY KEY, mtime INTEGER, rules TEXT,'
+                         ' subdirs TEXT) WITHOUT ROWID')
+
+    @staticmethod
+    def key(stat):
+        return struct.pack('<QQ', *dir_key(stat))
+
+    def unchanged_subdirs(self, directory):
+        count('stats')
+        try:
+            stat = FS.stat(directory)
+        except OSError:
+            return None
+        row = self._db.execute(
+            'SELECT mtime, rules, subdirs FROM dirs WHERE key = ?',
+            (self.key(stat),)).fetchone()
+        if row is None or row[:2] != (stat.st_mtime_ns, self._rules):
+            return None
+        return json.loads(row[2])
+
+    def record(self, stat, subdirs):
+        # stat is that of the directory once its batch was applied
+        self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                         (self.key(stat), stat.st_mtime_ns, self._rules,
+                          json.dumps(subdirs)))
+
+    def close(self, commit):
+        if commit:
+            self._db.commit()
+        self._db.close()
+
+
+def dir_key(stat):
+    return stat.st_dev, stat.st_ino
+
+
+def _is_skipped(entry, skip_dirs):
+    return bool(skip_dirs) and \
+        dir_key(entry.stat(follow_symlinks=False)) in skip_dirs
+
+
+class _KnownDir:
+
+    # Stands in for the DirEntry of a subdirectory remembered by DirState
+    def __init__(self, root, name):
+        self.name = name
+        self.path = join(root, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            count('stats')
+            self._stat = FS.stat(self.path, follow_symlinks=follow_symlinks)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=False):
+        try:
+            return S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _open_dir(path, exclude_dirs, dir_state):
+    # Returns (path, dirs, files, children to descend into, listed)
+    if dir_state is not None:
+        names = dir_state.unchanged_subdirs(path)
+        if names is not None:
+            children = [_KnownDir(path, name) for name in names]
+            return path, [], [], iter(children), False
+    dirs, files = _scan_dir(path, exclude_dirs)
+    return path, dirs, files, iter(dirs), True
+
+
+def walk(top, exclude_dirs, skip_dirs=frozenset(), dir_state=None):
+    # Bottom-up like os.walk(topdown=False), but yields the DirEntry objects
+    # so their cached type information is not looked up again. Directories
+    # in skip_dirs are still listed in their parent but not descended into,
+    # and directories dir_state knows to be unchanged are descended into
+    # without being listed or yielded.
+    stack = [_open_dir(top, exclude_dirs, dir_state)]
+    while stack:
+        root, dirs, files, pending, listed = stack[-1]
+        for entry in pending:
+            if entry.is_dir(follow_symlinks=False) and \
+                    not _is_skipped(entry, skip_dirs):
+                stack.append(_open_dir(entry.path, exclude_dirs, dir_state))
+                break
+        else:
+            stack.pop()
+            if listed:
+                yield root, dirs, files
+
+
+class Entry:
+
+    # A file to rename: entries of one directory share its path string, and
+    # the full path is only joined when needed
+    __slots__ = ('directory', 'name')
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+
+    @property
+    def path(self):
+        return join(self.directory, self.name)
+
+
+class DirIndex:
+
+    # File names per directory, keyed by their lower case form, and the
+    # names of all entries per directory, grouped by their lower case form:
+    # filled in by the walk, and listed once on demand for directories that
+    # only hold explicitly given targets.
+    def __init__(self):
+        self._names = {}
+        self._taken = {}
+
+    def add(self, directory, files, dirs=()):
+        names = {}
+        for entry in files:
+            names.setdefault(entry.name.lower(), entry.name)
+        self._names[directory] = names
+        taken = {}
+        for entry in chain(files, dirs):
+            taken.setdefault(entry.name.lower(), set()).add(entry.name)
+        self._taken[directory] = taken
+
+    def _list(self, directory):
+        dirs, files = _scan_dir(directory or os.curdir, frozenset())
+        self.add(directory, files, dirs)
+
+    def names(self, directory):
+        if directory not in self._names:
+            self._list(directory)
+        return self._names[directory]
+
+    def taken(self, directory):
+        if directory not in self._taken:
+            self._list(directory)
+        return self._taken[directory]
+
+    def rename(self, moves):
+        # Brings the names up to date with moves planned but not yet applied
+        for move_ in moves:
+            taken = self._taken.get(move_.directory)
+            if taken is None:
+                continue
+            variants = taken.get(move_.name.lower())
+            if variants is not None:
+                variants.discard(move_.name)
+            taken.setdefault(move_.new_name.lower(), set()).add(move_.new_name)
+
+
+def find_batches(targets, session):
+    # Yields (root, dirs, files, index) one directory at a time, children
+    # before parents, so each batch can be renamed as soon as it has been
+    # listed. Targets given explicitly come in batches without a root: their
+    # files grouped by directory, so that each directory is listed once for
+    # every TARGETS_CHUNK_SIZE targets, and all their directories last.
+    # Numbered names are counted and sorted per directory, so with a name
+    # the files of each directory are kept together across all chunks.
+    options = session.options
+    target_dirs = []
+    exclude_dirs = frozenset(options.exclude_dirs)
+
+    targets = iter(targets)
+    target_files = {}
+    while True:
+        chunk = list(islice(targets, TARGETS_CHUNK_SIZE))
+        if not chunk:
+            break
+        if not options.name:
+            target_files = {}
+        for target in chunk:
+            if is_under_excluded_dirs(target, exclude_dirs):
+                continue
+            target_path = os.path.abspath(join(options.cwd, target))
+            count('stats')
+            try:
+                stat = FS.stat(target_path)
+            except OSError:
+                continue
+            if S_ISDIR(stat.st_mode):
+                if options.is_recursive and \
+                        dir_key(stat) not in session.skip_dirs:
+                    yield from _walk_batches(target_path, session,
+                                             exclude_dirs)
+                target_dirs.append(target_path)
+            elif S_ISREG(stat.st_mode):
+                directory, name = os.path.split(target_path)
+                directory = sys.intern(directory)
+                target_files.setdefault(directory, []).append(
+                    Entry(directory, name))
+        if not options.name:
+            for files in target_files.values():
+                yield None, [], files, DirIndex()
+
+    if options.name:
+        for files in target_files.values():
+            yield None, [], files, DirIndex()
+    yield None, target_dirs, [], DirIndex()
+
+
+def _walk_batches(top, session, exclude_dirs):
+    for root, dirs, files in walk(top, exclude_dirs, session.skip_dirs,
+                                  session.dir_state):
+        index = DirIndex()
+        index.add(root, files, dirs)
+        yield (root, [entry.path for entry in dirs],
+               [Entry(root, entry.name) for entry in files], index)
+
+
+class Plan:
+
+    def __init__(self):
+        self.moves = []
+        self.steps = []
+        self.conflicts = []
+
+
+class TreePlan:
+
+    # The (root, dirs, files plan, dirs plan) of every directory, in the
+    # order they are applied. A plan read back from a file also holds the
+    # (inode, mtime) its sources had when it was made.
+    def __init__(self, options, batches, guards=None):
+        self.options = options
+        self.batches = batches
+        self.guards = guards
+
+    def plans(self):
+        for _, _, files_plan, dirs_plan in self.batches:
+            yield files_plan
+            yield dirs_plan
+
+    @property
+    def moves(self):
+        return [move_ for plan_ in self.plans() for move_ in plan_.moves]
+
+    @property
+    def conflicts(self):
+        return [error for plan_ in self.plans()
+                for error in plan_.conflicts]
+
+
+def _conflict(move_, strerror):
+    error = MoveError(errno.EEXIST, strerror, move_.src, None, move_.dest)
+    error.move = move_
+    return error
+
+
+def _temporary_name(path, taken):
+    tmp_path = f'{path}.tmp'
+    counter = 1
+    while tmp_path in taken or FS.lexists(tmp_path):
+        tmp_path = f'{path}.{counter}.tmp'
+        counter += 1
+    return tmp_path
+
+
+def _find_conflicts(moves, reserved, index):
+    conflicts = {}
+    groups = {}
+    for move_ in moves:
+        if move_.group is not None:
+            groups.setdefault(move_.group, []).append(move_)
+
+    def block(move_, strerror):
+        # A file and its sidecars are renamed together or not at all;
+        # returns the sources blocked just now
+        blocked = []
+        for member in groups.get(move_.group, [move_]):
+            if member.src not in conflicts:
+                conflicts[member.src] = _conflict(
+                    member, strerror if member is move_ else
+                    'A companion item cannot be renamed')
+                blocked.append(member.src)
+        return blocked
+
+    claimed = {}
+    for move_ in moves:
+        if move_.dest in claimed:
+            block(move_, 'Another item is renamed to the same name')
+        else:
+            claimed[move_.dest] = move_
+    # A source that is renamed as well frees its name; any other name that
+    # is taken blocks the move
+    sources = {move_.src for move_ in moves}
+    for move_ in moves:
+        if move_.src in conflicts or move_.dest in sources:
+            continue
+        if move_.dest in reserved or \
+                _is_taken(move_, move_.new_name, index):
+            block(move_, os.strerror(errno.EEXIST))
+    # A blocked move keeps its source in place, which in turn blocks the
+    # move that wanted that name: each block is followed once
+    pending = list(conflicts)
+    while pending:
+        move_ = claimed.get(pending.pop())
+        if move_ is not None and move_.src not in conflicts:
+            pending.extend(block(move_, os.strerror(errno.EEXIST)))
+    return conflicts
+
+
+def _is_taken(move_, new_name, index):
+    # Hash lookups settle almost every name; only an entry that differs from
+    # new_name in case alone may or may not be the same name on this
+    # filesystem
+    variants = index.taken(move_.directory).get(new_name.lower())
+    if not variants:
+        return False
+    if new_name in variants:
+        return True
+    if variants == {move_.name}:
+        return False
+    dest = join(move_.directory, new_name)
+    return FS.lexists(dest) and not _is_same_file(move_.src, dest)
+
+
+def _suffix_collisions(moves, reserved, index):
+    # Gives every item whose new name is taken, on disk or by an item before
+    # it, the first free name with _N after its stem, and its sidecars the
+    # matching names. Sources are free since they are renamed as well.
+    sources = {move_.src for move_ in moves}
+    claimed = set(reserved)
+    groups = {}
+    for move_ in moves:
+        groups.setdefault(move_.group or move_.src, []).append(move_)
+
+    def is_free(move_):
+        return move_.dest not in claimed and \
+            (move_.dest in sources or
+             not _is_taken(move_, move_.new_name, index))
+
+    suffixed = []
+    for members in groups.values():
+        stem = members[0].new_name
+        if members[0].kind != 'dir':
+            stem = os.path.splitext(stem)[0]
+        group = members
+        number = 0
+        while not all(is_free(move_) for move_ in group):
+            number += 1
+            group = [_move(move_.directory, move_.name,
+                           f'{stem}_{number}{move_.new_name[len(stem):]}',
+                           move_.kind, move_.group)
+                     for move_ in members]
+        claimed.update(move_.dest for move_ in group)
+        suffixed.extend(group)
+    return suffixed
+
+
+def _hold(plans):
+    # A single conflict keeps every item of the plans in place
+    if any(plan_.conflicts for plan_ in plans):
+        for plan_ in plans:
+            plan_.moves = []
+            plan_.steps = []
+
+
+def _order_moves(moves, steps, taken):
+    by_src = {move_.src: move_ for move_ in moves}
+    blocked_by = {move_.src: by_src.get(move_.dest) for move_ in moves}
+    wanted = {move_.dest for move_ in moves if move_.dest in by_src}
+    done = set()
+
+    def run_chain(move_):
+        chain = []
+        while move_ is not None and move_.src not in done:
+            done.add(move_.src)
+            chain.append(move_)
+            move_ = blocked_by[move_.src]
+        return chain, move_
+
+    # Chains are applied from their free end backwards; every remaining move
+    # is part of a permutation cycle and needs one temporary name to break it.
+    for move_ in moves:
+        if move_.src not in wanted:
+            chain, _ = run_chain(move_)
+            steps.extend((step.src, step.dest, step) for step in
+                         reversed(chain))
+    for move_ in moves:
+        if move_.src in done:
+            continue
+        cycle, _ = run_chain(move_)
+        tmp_path = _temporary_name(move_.src, taken)
+        taken.add(tmp_path)
+        steps.append((move_.src, tmp_path, None))
+        steps.extend((step.src, step.dest, step) for step in
+                     reversed(cycle[1:]))
+        steps.append((tmp_path, move_.dest, move_))
+
+
+def plan_renames(moves, reserved=frozenset(), index=None, policy='skip'):
+    # Names in reserved are treated as taken, as by an earlier plan that is
+    # still to be applied. Names on disk are looked up in the index, which
+    # lists each directory once. Under the suffix policy, items whose name
+    # is taken get another one; otherwise they are conflicts.
+    index = DirIndex() if index is None else index
+    plan_ = Plan()
+    seen = set()
+    for move_ in moves:
+        if move_.src != move_.dest and move_.src not in seen:
+            seen.add(move_.src)
+            if move_.directory is None:
+                move_ = _with_names(move_)
+            plan_.moves.append(move_)
+    count('no_ops', len(moves) - len(plan_.moves))
+
+    if policy == 'suffix':
+        plan_.moves = _suffix_collisions(plan_.moves, reserved, index)
+    conflicts = _find_conflicts(plan_.moves, reserved, index)
+    plan_.conflicts = list(conflicts.values())
+    plan_.moves = [move_ for move_ in plan_.moves
+                   if move_.src not in conflicts]
+
+    plan_.steps = _order_steps(plan_.moves)
+    return plan_
+
+
+def _order_steps(moves):
+    steps = []
+    groups = {}
+    for move_ in moves:
+        groups.setdefault(move_.directory, []).append(move_)
+    taken = {move_.dest for move_ in moves}
+    for group in groups.values():
+        _order_moves(group, steps, taken)
+    return steps
+
+
+def _apply_steps(steps, journal):
+    # Returns (move, error) for every step that failed; the move is None
+    # for the first half of a step through a temporary name
+    failed = []
+    step_ids = [None] * len(steps)
+    if journal is not None:
+        step_ids = journal.plan([(src, dest) for src, dest, _ in steps])
+    for step_id, (src, dest, move_) in zip(step_ids, steps):
+        try:
+            move(src, dest)
+        except MoveError as error:
+            failed.append((move_, error))
+            continue
+        if journal is not None:
+            journal.done(step_id)
+    return failed
+
+
+def _apply(plan_, session):
+    # Safe to run in worker threads: the session is only read
+    if session.options.is_dry_run:
+        return []
+    with timer('apply'):
+        return _apply_steps(plan_.steps, session.journal)
+
+
+def apply_plan(plan_, session):
+    return _report(plan_, _apply(plan_, session), session)
+
+
+def _report(plan_, failed, session):
+    output = session.output
+    with timer('apply'):
+        errors = plan_.conflicts + [error for _, error in failed]
+        session.errors.extend(errors)
+        session.failed_dirs.update(dirname(error.filename)
+                                   for error in errors)
+        failed_moves = {move_ for move_, _ in failed}
+        renamed = [move_ for move_ in plan_.moves
+                   if move_ not in failed_moves]
+        for error in plan_.conflicts:
+            output.failed(error.move, error, 'conflict')
+        for move_, error in failed:
+            if move_ is None:
+                move_ = Move(error.filename, error.filename2, None)
+            output.failed(move_, error, 'failed')
+        for move_ in renamed:
+            output.moved(move_)
+    count('conflicts', len(plan_.conflicts))
+    count('failures', len(failed))
+    count('renames', len(renamed))
+    return renamed
+
+
+class JournalState:
+
+    def __init__(self):
+        self.steps = {}
+        self.done = {}
+        self.undone = set()
+        self.finished = set()
+
+
+def read_journal(path):
+    state = JournalState()
+    try:
+        file = open(path, encoding='utf-8', errors='surrogateescape')
+    except FileNotFoundError:
+        return state
+    with file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line torn by a crash; its renames never started
+                continue
+            if record[0] == 'P':
+                state.steps[record[1]] = (record[2], record[3])
+            elif record[0] == 'D':
+                state.done[record[1]] = None
+            elif record[0] == 'U':
+                state.undone.add(record[1])
+            elif record[0] == 'F':
+                state.finished.add((record[1], record[2]))
+    return state
+
+
+class Journal:
+
+    # Append-only log of renames: planned steps ('P') reach the OS before
+    # they are applied and are followed by 'D' once done, 'U' once undone,
+    # and 'F' marks a directory whose batch completed. Records are fsynced
+    # in groups; a rename whose 'D' was lost is recognised on resume by its
+    # source being gone and its destination being present. Batches applied
+    # side by side write to it from several threads.
+    def __init__(self, path):
+        self.state = read_journal(path)
+        self._next_id = max(self.state.steps, default=-1) + 1
+        self._file = open(path, 'a+', encoding='utf-8',
+                          errors='surrogateescape')
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != '\n':
+                self._file.write('\n')
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.RLock()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._unsynced += 1
+
+    def plan(self, steps):
+        with self._lock:
+            step_ids = range(self._next_id, self._next_id + len(steps))
+            for step_id, (src, dest) in zip(step_ids, steps):
+                self._write(['P', step_id, src, dest])
+            self._next_id += len(steps)
+            self._file.flush()
+            self._sync_if_due()
+        return step_ids
+
+    def done(self, step_id):
+        with self._lock:
+            self._write(['D', step_id])
+            self._sync_if_due()
+
+    def undone(self, step_id):
+        with self._lock:
+            self._write(['U', step_id])
+            self._sync_if_due()
+
+    def finish(self, stat):
+        key = dir_key(stat)
+        with self._lock:
+            self._write(['F', *key])
+            self._file.flush()
+            self._sync_if_due()
+
+    def _sync_if_due(self):
+        if self._unsynced >= JOURNAL_SYNC_SIZE or \
+                time.monotonic() - self._synced_at >= JOURNAL_SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._synced_at = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def resume_journal(journal, output):
+    # Finishes the steps that were planned but not recorded as done; the
+    # journal does not know what kind of item they rename
+    state = journal.state
+    rename_cnt = 0
+    for step_id, (src, dest) in state.steps.items():
+        if step_id in state.done or step_id in state.undone:
+            continue
+        if FS.lexists(src):
+            try:
+                move(src, dest)
+            except MoveError as error:
+                output.failed(Move(src, dest, None), error, 'failed')
+                continue
+            output.moved(Move(src, dest, None))
+            rename_cnt += 1
+        elif not FS.lexists(dest):
+            continue
+        journal.done(step_id)
+    return rename_cnt
+
+
+def undo_journal(journal, output):
+    state = journal.state
+    rename_cnt = 0
+    for step_id in reversed(state.done):
+        if step_id in state.undone:
+            continue
+        src, dest = state.steps[step_id]
+        try:
+            move(dest, src)
+        except MoveError as error:
+            output.failed(Move(dest, src, None), error, 'failed')
+            continue
+        journal.undone(step_id)
+        output.moved(Move(dest, src, None))
+        rename_cnt += 1
+    return rename_cnt
+
+
+class Inotify:
+
+    # Minimal ctypes binding. Watched directories are kept as (parent watch,
+    # name) so their paths stay right when a parent directory is renamed.
+    def __init__(self):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number))
+        self._dirs = {}
+
+    def add(self, path, parent=None, name=None):
+        watch_descriptor = self._add_watch(self.fd, os.fsencode(path),
+                                           WATCH_MASK)
+        if watch_descriptor < 0:
+            error_number = self._get_errno()
+            raise OSError(error_number, os.strerror(error_number), path)
+        self._dirs[watch_descriptor] = (parent, name or path)
+        return watch_descriptor
+
+    def add_tree(self, path, exclude_dirs, parent=None, name=None):
+        watch_descriptor = self.add(path, parent, name)
+        for entry in _scan_dir(path, exclude_dirs)[0]:
+            if entry.is_dir(follow_symlinks=False):
+                self.add_tree(entry.path, exclude_dirs, watch_descriptor,
+                              entry.name)
+
+    def path(self, watch_descriptor):
+        parent, name = self._dirs[watch_descriptor]
+        return name if parent is None else join(self.path(parent), name)
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, _, length = \
+                _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\x00'))
+            offset += length
+            if mask & IN_IGNORED:
+                self._dirs.pop(watch_descriptor, None)
+            elif watch_descriptor in self._dirs or mask & IN_Q_OVERFLOW:
+                yield watch_descriptor, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _late_sidecar_moves(paths, recent, extensions):
+    # Sidecars arriving after their file was renamed follow it to its new
+    # name; anything else is left to the regular rules.
+    moves = []
+    others = []
+    for path in paths:
+        directory, name = os.path.split(path)
+        for extension in extensions:
+            if not name.lower().endswith(f'.{extension}'):
+                continue
+            prefix = name[:-len(extension) - 1]
+            new_prefix = recent.get((directory, prefix.lower()))
+            if new_prefix is not None:
+                moves.append(Move(path, new_prefix + name[len(prefix):],
+                                  'sidecar'))
+                break
+        else:
+            others.append(path)
+    return moves, others
+
+
+def _remember_renames(renamed, recent, produced):
+    for move_ in renamed:
+        produced.add(move_.dest)
+        if move_.kind != 'file' or not is_image(move_.name):
+            continue
+        directory, name = move_.directory, move_.name
+        recent[(directory, name.lower())] = move_.dest
+        recent[(directory, os.path.splitext(name)[0].lower())] = \
+            os.path.splitext(move_.dest)[0]
+    while len(recent) > WATCH_RECENT_SIZE:
+        recent.popitem(last=False)
+
+
+def _is_inside(path, directories):
+    parent = dirname(path)
+    while parent != path:
+        if parent in directories:
+            return True
+        path, parent = parent, dirname(parent)
+    return False
+
+
+def _flush_arrivals(pending, inotify, recent, produced, session):
+    options = session.options
+    paths = [path for path in pending if os.path.lexists(path)]
+    if options.is_recursive:
+        # Entries inside a new directory are handled by walking it
+        paths = [path for path in paths if not _is_inside(path, pending)]
+    moves, paths = _late_sidecar_moves(paths, recent,
+                                       options.sidecar_extensions)
+    plan_ = plan_renames(moves, policy=options.on_conflict)
+    if options.on_conflict == 'abort':
+        _hold([plan_])
+    renamed = apply_plan(plan_, session)
+    rename_batches(find_batches(paths, session), session, renamed)
+    _remember_renames(renamed, recent, produced)
+    if not options.is_recursive:
+        return
+    # Watch the whole of every new directory, under its final name
+    new_paths = {move_.src: move_.dest for move_ in renamed}
+    exclude_dirs = frozenset(options.exclude_dirs)
+    for path in paths:
+        new_path = new_paths.get(path, path)
+        if os.path.isdir(new_path) and not os.path.islink(new_path):
+            try:
+                inotify.add_tree(new_path, exclude_dirs, pending[path],
+                                 basename(new_path))
+            except OSError:
+                pass
+
+
+def _queue_events(inotify, pending, produced, targets, session):
+    options = session.options
+    exclude_dirs = frozenset(options.exclude_dirs)
+    for descriptor, mask, name in inotify.read():
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: look at everything once more
+            rename_batches(find_batches(targets, session), session)
+            continue
+        # New files are picked up once they are closed after writing
+        if mask & IN_CREATE and not mask & IN_ISDIR:
+            continue
+        path = join(inotify.path(descriptor), name)
+        if mask & IN_ISDIR and options.is_recursive and \
+                name not in exclude_dirs:
+            try:
+                inotify.add(path, descriptor, name)
+            except OSError:
+                pass
+        if path in produced:
+            produced.discard(path)
+            continue
+        pending.pop(path, None)
+        pending[path] = descriptor
+
+
+def watch(targets, session):
+    import select
+    options = session.options
+    inotify = Inotify()
+    exclude_dirs = frozenset(options.exclude_dirs)
+    try:
+        for target in targets:
+            path = os.path.abspath(join(options.cwd, target))
+            if options.is_recursive:
+                inotify.add_tree(path, exclude_dirs)
+            else:
+                inotify.add(path)
+    except OSError as error:
+        inotify.close()
+        print(f'format: cannot watch: {error}', file=sys.stderr)
+        return
+    if options.is_dry_run:
+        session.output.message('DRY-RUN\n')
+
+    # Arrivals are handled once no event came for WATCH_DEBOUNCE_SECONDS,
+    # or WATCH_MAX_DELAY_SECONDS after the first one during a long burst.
+    pending = OrderedDict()
+    recent = OrderedDict()
+    produced = set()
+    flush_at = None
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(WATCH_DEBOUNCE_SECONDS,
+                                     flush_at - time.monotonic()))
+            if timeout != 0 and \
+                    select.select([inotify.fd], [], [], timeout)[0]:
+                if not pending:
+                    flush_at = time.monotonic() + WATCH_MAX_DELAY_SECONDS
+                _queue_events(inotify, pending, produced, targets, session)
+                continue
+            _flush_arrivals(pending, inotify, recent, produced, session)
+            session.output.flush()
+            pending.clear()
+            # Errors have been reported; do not hold on to them forever
+            session.errors.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+
+
+def _load_renameat2():
+    # The returned function gives the errno of the call, 0 on success
+    if not sys.platform.startswith('linux'):
+        return False
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                          ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    renameat2.errcheck = \
+        lambda result, *_: ctypes.get_errno() if result else 0
+    return renameat2
+
+
+def _move_error(error_number, src, dest):
+    return MoveError(error_number, os.strerror(error_number), src, None, dest)
+
+
+def _is_same_file(src, dest):
+    try:
+        src_stat = FS.lstat(src)
+        dest_stat = FS.lstat(dest)
+    except OSError:
+        return False
+    return (src_stat.st_dev, src_stat.st_ino) == \
+        (dest_stat.st_dev, dest_stat.st_ino)
+
+
+def move(src, dest):
+    # Never replaces an existing dest
+    FS.move(src, dest)
+
+
+class OsFileSystem:
+
+    # Where the tree is read and renamed: the disk, through the os module.
+    # Everything that looks at the tree goes through FS, which tests can
+    # point at a MemoryFileSystem instead. The journal, caches and plan
+    # files always live on disk.
+    def scandir(self, path):
+        return os.scandir(path)
+
+    def stat(self, path, follow_symlinks=True):
+        return os.stat(path, follow_symlinks=follow_symlinks)
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def lexists(self, path):
+        return os.path.lexists(path)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def move(self, src, dest):
+        # renameat2(RENAME_NOREPLACE) when the kernel supports it, otherwise
+        # an existence check before os.rename
+        global _RENAMEAT2
+        if _RENAMEAT2 is None:
+            _RENAMEAT2 = _load_renameat2()
+        if _RENAMEAT2:
+            error_number = _RENAMEAT2(AT_FDCWD, os.fsencode(src),
+                                      AT_FDCWD, os.fsencode(dest),
+                                      RENAME_NOREPLACE)
+            if error_number == 0:
+                return
+            if error_number == errno.ENOSYS:
+                _RENAMEAT2 = False
+            elif error_number not in (errno.EINVAL, errno.EEXIST):
+                raise _move_error(error_number, src, dest)
+        if os.path.lexists(dest) and not _is_same_file(src, dest):
+            raise _move_error(errno.EEXIST, src, dest)
+        try:
+            os.rename(src, dest)
+        except OSError as error:
+            raise _move_error(error.errno, src, dest) from error
+
+
+MemoryStat = namedtuple('MemoryStat', ['st_mode', 'st_ino', 'st_dev',
+                                       'st_size', 'st_mtime_ns', 'st_mtime'])
+
+
+class _MemoryNode:
+
+    def __init__(self, inode, mtime_ns, content=None):
+        self.inode = inode
+        self.mtime_ns = mtime_ns
+        # None for a directory, which holds its children by name instead
+        self.content = content
+        self.children = {} if content is None else None
+
+    def stat(self):
+        mode = S_IFDIR | 0o755 if self.content is None else S_IFREG | 0o644
+        size = 0 if self.content is None else len(self.content)
+        return MemoryStat(mode, self.inode, 0, size, self.mtime_ns,
+                          self.mtime_ns / 1e9)
+
+
+class _MemoryEntry:
+
+    # Stands in for os.DirEntry
+    def __init__(self, directory, name, node):
+        self.name = name
+        self.path = join(directory, name)
+        self._node = node
+
+    def is_dir(self, follow_symlinks=True):
+        return self._node.content is None
+
+    def is_symlink(self):
+        return False
+
+    def stat(self, follow_symlinks=True):
+        return self._node.stat()
+
+
+class MemoryFileSystem:
+
+    # A case sensitive tree without symlinks, held in memory for tests.
+    # Times come from a clock that moves on by tick_ns with every change, so
+    # entries get distinct mtimes without waiting; an explicit mtime_ns can
+    # be given when creating them. Paths must be absolute.
+    def __init__(self, clock_ns=0, tick_ns=1000000000):
+        self.clock_ns = clock_ns
+        self.tick_ns = tick_ns
+        self._inodes = 1
+        self._root = _MemoryNode(self._inodes, clock_ns)
+
+    def _now(self):
+        self.clock_ns += self.tick_ns
+        return self.clock_ns
+
+    def _node(self, path):
+        node = self._root
+        for name in path.split(os.sep):
+            if not name:
+                continue
+            if node.content is not None:
+                raise NotADirectoryError(errno.ENOTDIR,
+                                         os.strerror(errno.ENOTDIR), path)
+            if name not in node.children:
+                raise FileNotFoundError(errno.ENOENT,
+                                        os.strerror(errno.ENOENT), path)
+            node = node.children[name]
+        return node
+
+    def _add(self, path, content, mtime_ns):
+        parent = self.mkdir(dirname(path))
+        name = basename(path)
+        if name in parent.children:
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  path)
+        self._inodes += 1
+        node = _MemoryNode(self._inodes,
+                           self._now() if mtime_ns is None else mtime_ns,
+                           content)
+        parent.children[name] = node
+        parent.mtime_ns = self._now()
+        return node
+
+    def mkdir(self, path, mtime_ns=None):
+        # Creates the missing parents as well, like os.makedirs
+        try:
+            node = self._node(path)
+        except FileNotFoundError:
+            return self._add(path, None, mtime_ns)
+        if node.content is not None:
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  path)
+        return node
+
+    def write(self, path, content=b'', mtime_ns=None):
+        self._add(path, content, mtime_ns)
+
+    def read(self, path):
+        return self._node(path).content
+
+    def listdir(self, path):
+        return sorted(self._node(path).children)
+
+    def scandir(self, path):
+        node = self._node(path)
+        if node.content is not None:
+            raise NotADirectoryError(errno.ENOTDIR,
+                                     os.strerror(errno.ENOTDIR), path)
+        return nullcontext([_MemoryEntry(path, name, child)
+                            for name, child in node.children.items()])
+
+    def stat(self, path, follow_symlinks=True):
+        return self._node(path).stat()
+
+    def lstat(self, path):
+        return self._node(path).stat()
+
+    def lexists(self, path):
+        try:
+            self._node(path)
+        except OSError:
+            return False
+        return True
+
+    def open(self, path):
+        content = self._node(path).content
+        if content is None:
+            raise IsADirectoryError(errno.EISDIR,
+                                    os.strerror(errno.EISDIR), path)
+        return io.BytesIO(content)
+
+    def move(self, src, dest):
+        try:
+            node = self._node(src)
+            parent = self._node(dirname(dest))
+        except OSError as error:
+            raise _move_error(error.errno, src, dest) from error
+        if parent.content is not None:
+            raise _move_error(errno.ENOTDIR, src, dest)
+        if basename(dest) in parent.children:
+            raise _move_error(errno.EEXIST, src, dest)
+        if (dest + os.sep).startswith(src + os.sep):
+            raise _move_error(errno.EINVAL, src, dest)
+        source_parent = self._node(dirname(src))
+        del source_parent.children[basename(src)]
+        parent.children[basename(dest)] = node
+        source_parent.mtime_ns = parent.mtime_ns = self._now()
+
+
+FS = OsFileSystem()
+
+
+class Output:
+
+    # Reports every item with its status: renamed, planned in a dry run,
+    # conflict or failed. Errors always go to stderr as well.
+    def __init__(self, file, is_dry_run):
+        self._file = file
+        self._is_dry_run = is_dry_run
+        self.counts = dict.fromkeys(
+            ['renamed', 'planned', 'conflict', 'failed'], 0)
+
+    def message(self, text):
+        pass
+
+    def moved(self, move_):
+        status = 'planned' if self._is_dry_run else 'renamed'
+        self.counts[status] += 1
+        self._write(move_, status, None)
+
+    def failed(self, move_, error, status):
+        print(f'format: {error}', file=sys.stderr)
+        self.counts[status] += 1
+        self._write(move_, status, error)
+
+    def _write(self, move_, status, error):
+        pass
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+
+
+class TextOutput(Output):
+
+    def message(self, text):
+        self._file.write(f'{text}\n')
+
+    def _write(self, move_, status, error):
+        if error is not None:
+            return
+        word = '~~>' if self._is_dry_run else '-->'
+        old_name = basename(move_.src)
+        self._file.write(f'{old_name:<50} {word:} {basename(move_.dest)}\n')
+
+
+class JsonlOutput(Output):
+
+    def _write(self, move_, status, error):
+        record = {'type': 'item', 'src': move_.src, 'dest': move_.dest,
+                  'kind': move_.kind, 'status': status}
+        if error is not None:
+            record['error'] = error.strerror
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._file.write(json.dumps({'type': 'summary', **self.counts}) +
+                         '\n')
+        self.flush()
+
+
+_TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                              '\r': '\\r'})
+
+
+class TsvOutput(Output):
+
+    # Backslashes, tabs and line breaks in names are escaped as \\, \t,
+    # \n and \r; the summary line holds name=count fields.
+    def _write(self, move_, status, error):
+        self._file.write('\t'.join([
+            status, move_.kind or '', move_.src.translate(_TSV_ESCAPES),
+            move_.dest.translate(_TSV_ESCAPES)]) + '\n')
+
+    def close(self):
+        self._file.write('\t'.join(['summary', *[
+            f'{status}={count}' for status, count in self.counts.items()]]) +
+                         '\n')
+        self.flush()
+
+
+OUTPUTS = {
+    'text': TextOutput,
+    'jsonl': JsonlOutput,
+    'tsv': TsvOutput,
+    'none': Output,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
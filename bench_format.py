@@ -0,0 +1,318 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+import argparse
+import builtins
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import py_compile
+import random
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import _format as frmt
+
+
+PWD = os.path.dirname(os.path.realpath(__file__))
+SHAPES = ['flat', 'deep', 'wide', 'sidecars', 'exif']
+SIZES = [10000, 100000, 1000000]
+PHASES = ['discover', 'sort', 'plan', 'apply']
+SEED = 1234
+DIR_SIZE = 1000
+DEEP_LEVELS = 100
+WORDS = ['Holiday', 'BEACH', 'family', 'Season', 'Extras', 'Of', 'the',
+         'Summer', 'TRIP', 'party']
+SIDECARS = ['pp3', 'xmp', 'json']
+STARTUP_RUNS = 20
+# How much later than a bare interpreter a dry run on one file may finish,
+# run as frmt does: python format.py
+STARTUP_BUDGET_SECONDS = 0.05
+
+
+def _exif_jpeg(date_taken):
+    date = date_taken.strftime(frmt.EXIF_DATE_FORMAT).encode() + b'\x00'
+    exif_ifd_offset = 8 + 2 + 12 + 4
+    date_offset = exif_ifd_offset + 2 + 12 + 4
+    tiff = b''.join([
+        b'II', struct.pack('<HI', 42, 8),
+        struct.pack('<HHHII', 1, frmt.EXIF_IFD_POINTER, 4, 1,
+                    exif_ifd_offset),
+        struct.pack('<I', 0),
+        struct.pack('<HHHII', 1, frmt.DATE_TIME_ORIGINAL, 2, len(date),
+                    date_offset),
+        struct.pack('<I', 0),
+        date])
+    app1 = b'Exif\x00\x00' + tiff
+    return b''.join([b'\xff\xd8', b'\xff\xe1', struct.pack('>H',
+                                                            len(app1) + 2),
+                     app1, b'\xff\xda', struct.pack('>H', 2), b'\xff\xd9'])
+
+
+def _name(rng, index):
+    # Roughly half of the names already are in the target format
+    words = rng.sample(WORDS, 2)
+    if rng.random() < 0.5:
+        return f'{words[0]} {words[1]} {index:07d}'
+    return f'{words[0]}_{words[1]}_{index:07d}'.lower()
+
+
+def _write(path, content=b''):
+    with open(path, 'wb') as file:
+        file.write(content)
+
+
+def _mkdir(root, name):
+    path = os.path.join(root, name)
+    os.mkdir(path)
+    return path
+
+
+def _chunks(size, chunk_size):
+    for start in range(0, size, chunk_size):
+        yield start, min(size, start + chunk_size)
+
+
+def _generate_flat(rng, root, size):
+    directory = _mkdir(root, 'FLAT DIR')
+    for index in range(size):
+        _write(os.path.join(directory, f'{_name(rng, index)}.jpg'))
+
+
+def _generate_deep(rng, root, size):
+    directory = root
+    levels = min(DEEP_LEVELS, size)
+    for level, (start, end) in enumerate(_chunks(size, -(-size // levels))):
+        directory = _mkdir(directory, f'Level {level}')
+        for index in range(start, end - 1):
+            _write(os.path.join(directory, f'{_name(rng, index)}.txt'))
+
+
+def _generate_wide(rng, root, size):
+    for album, (start, end) in enumerate(_chunks(size, 10)):
+        directory = _mkdir(root, f'Album {album:06d}')
+        for index in range(start, end - 1):
+            _write(os.path.join(directory, f'{_name(rng, index)}.jpg'))
+
+
+def _generate_sidecars(rng, root, size):
+    group_size = 1 + len(SIDECARS)
+    for number, (start, end) in enumerate(_chunks(size // group_size,
+                                                  DIR_SIZE // group_size)):
+        directory = _mkdir(root, f'Raw Import {number}')
+        for index in range(start, end):
+            name = f'{_name(rng, index)}.JPG'
+            _write(os.path.join(directory, name))
+            for extension in SIDECARS:
+                _write(os.path.join(directory, f'{name}.{extension}'))
+
+
+def _generate_exif(rng, root, size):
+    start_date = datetime(2000, 1, 1)
+    for number, (start, end) in enumerate(_chunks(size, DIR_SIZE)):
+        directory = _mkdir(root, f'Camera Roll {number}')
+        for index in range(start, end):
+            date = start_date + timedelta(seconds=rng.randrange(10 ** 9))
+            _write(os.path.join(directory, f'{_name(rng, index)}.jpg'),
+                   _exif_jpeg(date))
+
+
+GENERATORS = {
+    'flat': _generate_flat,
+    'deep': _generate_deep,
+    'wide': _generate_wide,
+    'sidecars': _generate_sidecars,
+    'exif': _generate_exif,
+}
+
+
+class CallCounter:
+
+    # Counts the filesystem calls made through the os module, open() and
+    # format.move() (which may rename through renameat2 directly). Stat
+    # calls cached inside DirEntry objects are not visible here.
+    _OS_FUNCTIONS = ['stat', 'lstat', 'scandir', 'listdir', 'rename',
+                     'replace', 'mkdir', 'fsync']
+
+    def __init__(self):
+        self.count = 0
+
+    def _wrap(self, function):
+        def counted(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def install(self):
+        for name in self._OS_FUNCTIONS:
+            setattr(os, name, self._wrap(getattr(os, name)))
+        builtins.open = self._wrap(builtins.open)
+        frmt.move = self._wrap(frmt.move)
+        return self
+
+
+@contextlib.contextmanager
+def _phase(results, name, counter):
+    calls = counter.count
+    start = time.perf_counter()
+    yield
+    results[name] = {'seconds': time.perf_counter() - start,
+                     'fs_calls': counter.count - calls}
+
+
+def run_scenario(shape, size, directory):
+    root = os.path.join(directory, shape)
+    os.mkdir(root)
+    GENERATORS[shape](random.Random(SEED), root, size)
+
+    options = frmt.Options(cwd=root, is_recursive=True, is_to_lower=True)
+    session = frmt.Session(options)
+    counter = CallCounter().install()
+    phases = {}
+    with _phase(phases, 'discover', counter):
+        batches = list(frmt.find_batches(os.listdir(root), session))
+    with _phase(phases, 'sort', counter):
+        for _, _, files, _ in batches:
+            frmt.sort_files(files, options._replace(name='bench'))
+    with _phase(phases, 'plan', counter):
+        plans = [(frmt.plan_renames(frmt.file_moves(files, index, options)),
+                  frmt.plan_renames(frmt.dir_moves(dirs, options)))
+                 for _, dirs, files, index in batches]
+    with _phase(phases, 'apply', counter):
+        for files_plan, dirs_plan in plans:
+            frmt.apply_plan(files_plan, session)
+            frmt.apply_plan(dirs_plan, session)
+
+    files = sum(len(files) for _, _, files, _ in batches)
+    for result in phases.values():
+        result['files_per_second'] = files / max(result['seconds'], 1e-9)
+    return {
+        'shape': shape,
+        'size': size,
+        'files': files,
+        'dirs': sum(len(dirs) for _, dirs, _, _ in batches),
+        'renames': sum(len(files_plan.moves) + len(dirs_plan.moves)
+                       for files_plan, dirs_plan in plans),
+        'phases': phases,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _median_run_time(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       cwd=PWD)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def measure_startup(directory, runs):
+    # The script is only a launcher; the module it imports is compiled
+    # here once, as the first run on an installation would
+    path = os.path.join(directory, 'Startup File.jpg')
+    _write(path)
+    py_compile.compile(os.path.join(PWD, '_format.py'), doraise=True)
+    python = _median_run_time([sys.executable, '-c', 'pass'], runs)
+    dry_run = _median_run_time(
+        [sys.executable, os.path.join(PWD, 'format.py'), '-d', path], runs)
+    module = _median_run_time(
+        [sys.executable, '-m', 'format', '-d', path], runs)
+    return {
+        'python_seconds': python,
+        'dry_run_seconds': dry_run,
+        'module_seconds': module,
+        'overhead_seconds': dry_run - python,
+        'budget_seconds': STARTUP_BUDGET_SECONDS,
+        'is_within_budget': dry_run - python <= STARTUP_BUDGET_SECONDS,
+    }
+
+
+def _format_version():
+    with open(os.path.join(PWD, '_format.py'), 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark format.py on generated trees')
+    parser.add_argument('-s', '--shapes', default=','.join(SHAPES),
+                        help='Comma separated tree shapes (default:'
+                        ' %(default)s)')
+    parser.add_argument('-n', '--sizes', default=str(SIZES[0]),
+                        help='Comma separated numbers of entries per tree,'
+                        f' e.g. {",".join(map(str, SIZES))} (default:'
+                        ' %(default)s)')
+    parser.add_argument('-d', '--dir', default=None,
+                        help='Where to generate the trees (default: a'
+                        ' temporary directory)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the JSON report to this file')
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS,
+                        help='Runs to take the median startup time of, 0 to'
+                        ' skip (default: %(default)s)')
+    parser.add_argument('--scenario', nargs=2, metavar=('SHAPE', 'SIZE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        shape, size = args.scenario
+        json.dump(run_scenario(shape, int(size), args.dir), sys.stdout)
+        return
+
+    startup = None
+    if args.startup_runs > 0:
+        directory = tempfile.mkdtemp(prefix='format-bench-', dir=args.dir)
+        try:
+            startup = measure_startup(directory, args.startup_runs)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        print(f'startup overhead={startup["overhead_seconds"]:.3f}s'
+              f' budget={STARTUP_BUDGET_SECONDS:.3f}s', file=sys.stderr)
+
+    # Each tree is measured in a fresh process so peak RSS is its own
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for shape in args.shapes.split(','):
+            directory = tempfile.mkdtemp(prefix='format-bench-',
+                                         dir=args.dir)
+            try:
+                output = subprocess.run(
+                    [sys.executable, os.path.realpath(__file__),
+                     '--scenario', shape, str(size), '--dir', directory],
+                    check=True, stdout=subprocess.PIPE, cwd=PWD).stdout
+                results.append(json.loads(output))
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            print(f'{shape:<10} {size:>8} ' + ' '.join(
+                f'{phase}={results[-1]["phases"][phase]["seconds"]:.3f}s'
+                for phase in PHASES), file=sys.stderr)
+
+    report = {
+        'format_version': _format_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': SEED,
+        'startup': startup,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,27 @@
 # pylint: disable=missing-class-docstring
 # pylint: disable=missing-function-docstring
 
+import errno
+import io
+import json
 import os
+import struct
+import sys
 import unittest
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
 from random import randint
 import hashlib
 from pathlib import Path
+from stat import S_ISDIR
 from time import sleep
 from checksumdir import dirhash
 
+import _format as frmt
+
 
 PWD = os.path.dirname(os.path.realpath(__file__))
 TEST_DIR = os.path.join(PWD, 'test')
@@ -47,6 +58,34 @@ def _hashfile(file):
     return sha256.hexdigest()
 
 
+def _exif_tiff(date_taken, endian='<'):
+    byte_order = b'II' if endian == '<' else b'MM'
+    date = date_taken.encode('ascii') + b'\x00'
+    exif_ifd_offset = 8 + 2 + 12 + 4
+    date_offset = exif_ifd_offset + 2 + 12 + 4
+    return b''.join([
+        byte_order, struct.pack(f'{endian}HI', 42, 8),
+        struct.pack(f'{endian}HHHII', 1, 0x8769, 4, 1, exif_ifd_offset),
+        struct.pack(f'{endian}I', 0),
+        struct.pack(f'{endian}HHHII', 1, 0x9003, 2, len(date), date_offset),
+        struct.pack(f'{endian}I', 0),
+        date])
+
+
+def _exif_jpeg(date_taken, endian='<'):
+    app0 = b'JFIF\x00' + 9 * b'\x00'
+    app1 = b'Exif\x00\x00' + _exif_tiff(date_taken, endian)
+    return b''.join([b'\xff\xd8',
+                     b'\xff\xe0', struct.pack('>H', len(app0) + 2), app0,
+                     b'\xff\xe1', struct.pack('>H', len(app1) + 2), app1,
+                     b'\xff\xda', struct.pack('>H', 2), b'\xff\xd9'])
+
+
+def _write_bytes(file_name, content):
+    with open(os.path.join(TEST_DIR, file_name), 'wb') as file:
+        file.write(content)
+
+
 def _hashdir(directory):
     return dirhash(directory, 'sha256')
 
@@ -55,10 +94,6 @@ def _create_dir(dir_name):
     Path(os.path.join(TEST_DIR, dir_name)).mkdir()
 
 
-def _remove_file(file_path):
-    Path(file_path).unlink()
-
-
 def _remove_dir(dir_path):
     shutil.rmtree(dir_path, ignore_errors=True)
 
@@ -89,12 +124,47 @@ def _create_dirs_and_files_from_tree(root_pwd, tree_dict):
             Path(full_path).touch()
             _add_random_content_to_file(full_path)
             hashes_dict[key] = _hashfile(full_path)
-        # add a delay to show different creating time stamps for each file,
-        # otherwise all files show the exact same creating time
-        sleep(10/1000)
     return hashes_dict
 
 
+def _memory_tree(tree, root='/test'):
+    # Files hold their original name, so renames can be followed
+    file_system = frmt.MemoryFileSystem()
+    file_system.mkdir(root)
+    _fill_memory_tree(file_system, root, tree)
+    return file_system
+
+
+def _fill_memory_tree(file_system, root, tree):
+    for name, children in tree.items():
+        path = os.path.join(root, name)
+        if isinstance(children, dict):
+            file_system.mkdir(path)
+            _fill_memory_tree(file_system, path, children)
+        else:
+            file_system.write(path, name.encode() if children is None
+                              else children)
+
+
+def _read_memory_tree(file_system, root='/test'):
+    tree = {}
+    for name in file_system.listdir(root):
+        path = os.path.join(root, name)
+        if S_ISDIR(file_system.stat(path).st_mode):
+            tree[name] = _read_memory_tree(file_system, path)
+        else:
+            tree[name] = file_system.read(path).decode(errors='replace')
+    return tree
+
+
+def _process_memory_tree(tree, targets, cwd='/test', **options):
+    file_system = _memory_tree(tree)
+    session = frmt.Session(frmt.Options(cwd=cwd, **options))
+    with mock.patch.object(frmt, 'FS', file_system):
+        frmt.process(targets, session)
+    return _read_memory_tree(file_system), session
+
+
 def _assert_tree_renaming(self,
                           expected_tree,
                           hashes_dict,
@@ -140,117 +210,133 @@ def assert_file_exists(self, path):
         path), msg=f'[{path}], doesn\'t exist')
 
 
-class TestRenameFile(unittest.TestCase):
+class TestCommandLine(unittest.TestCase):
 
-    _test_file_name = 'TEST FILE'
+    # End to end through frmt on disk; the scenarios below run in memory
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1.JPG': None,
+            'TEST FILE 1.JPG.pp3': None,
+            'TEST DIR 2': {
+                'TEST FILE 2.jpg': None,
+                'TEST FILE 2.jpg.pp3': None,
+                'TEST FILE 3.jpg.pp3': None,
+            }
+        }
+    }
 
     def setUp(self):
         _init_test_dir()
         os.chdir(TEST_DIR)
         self._env = _update_format_env_variable()
-        self._expected_hash = _create_file(self._test_file_name)
 
     def tearDown(self):
         _remove_dir(TEST_DIR)
 
-    def test_rename_file_remove_spaces(self):
-        expected_name = self._test_file_name.replace(' ', '_')
-        expected_path = os.path.join(TEST_DIR, expected_name)
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt "{self._test_file_name}"',
+    def _run(self, command):
+        subprocess.run(command,
                        shell=True,
                        check=True,
                        env=self._env,
                        stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(expected_path))
-        self.assertEqual(self._expected_hash, _hashfile(expected_path))
-        _remove_file(expected_path)
 
-    def test_rename_file_convert_to_lowercase(self):
-        expected_name = self._test_file_name.replace(' ', '_').lower()
-        expected_path = os.path.join(TEST_DIR, expected_name)
+    def test_rename_file_remove_spaces(self):
+        expected_hash = _create_file('TEST FILE')
+        expected_path = os.path.join(TEST_DIR, 'TEST_FILE')
+        self._run('frmt "TEST FILE"')
+        self.assertEqual(['TEST_FILE'], os.listdir(TEST_DIR))
+        self.assertEqual(expected_hash, _hashfile(expected_path))
+
+    def test_dry_run_does_not_modify_the_file(self):
+        expected_hash = _create_file('TEST FILE')
         hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt -l "{self._test_file_name}"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
+        self._run('frmt -d "TEST FILE"')
         self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(expected_path))
-        self.assertEqual(self._expected_hash, _hashfile(expected_path))
-        _remove_file(expected_path)
+        self.assertEqual(['TEST FILE'], os.listdir(TEST_DIR))
+        self.assertEqual(expected_hash, _hashfile('TEST FILE'))
 
-    def test_dry_run_does_not_modify_the_file(self):
-        expected_name = self._test_file_name.replace(' ', '_')
-        original_path = os.path.join(TEST_DIR, self._test_file_name)
-        expected_path = os.path.join(TEST_DIR, expected_name)
+    def test_recursive(self):
+        tree = {
+            'TEST DIR 1': {
+                'TEST FILE 1': None,
+                'TEST DIR 2': {
+                    'TEST FILE 2': None,
+                }
+            }
+        }
+        expected_renaming = {
+            'TEST_DIR_1': 'TEST DIR 1',
+            'TEST_FILE_1': 'TEST FILE 1',
+            'TEST_DIR_2': 'TEST DIR 2',
+            'TEST_FILE_2': 'TEST FILE 2',
+        }
+        expected_tree = {
+            'TEST_DIR_1': {
+                'TEST_FILE_1': None,
+                'TEST_DIR_2': {
+                    'TEST_FILE_2': None,
+                }
+            }
+        }
+        hashes_dict = _create_test_tree(tree)
         hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt -d "{self._test_file_name}"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
+        self._run('frmt -r "TEST DIR 1"')
         self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(original_path))
-        self.assertEqual(False, os.path.exists(expected_path))
-        self.assertEqual(self._expected_hash, _hashfile(original_path))
-        _remove_file(original_path)
+        _assert_tree_renaming(self, expected_tree, hashes_dict,
+                              expected_renaming, TEST_DIR)
+
+    def test_recursive_pp3_files(self):
+        hashes_dict = _create_test_tree(self._tree)
+        expected_renaming = {
+            'test_file_1.jpg': 'TEST FILE 1.JPG',
+            'test_file_1.jpg.pp3': 'TEST FILE 1.JPG.pp3',
+            'test_dir_2/test_file_2.jpg': 'TEST FILE 2.jpg',
+            'test_dir_2/test_file_2.jpg.pp3': 'TEST FILE 2.jpg.pp3',
+            'test_dir_2/test_file_3.jpg.pp3': 'TEST FILE 3.jpg.pp3',
+        }
+        self._run('frmt -r -l "TEST DIR 1/"')
+        self.assertEqual(['test_dir_1'], os.listdir(TEST_DIR))
+        for new_path, old_name in expected_renaming.items():
+            self.assertEqual(hashes_dict[old_name],
+                             _hashfile(os.path.join('test_dir_1', new_path)))
 
 
-class TestRenameDirectory(unittest.TestCase):
+class TestRenameFile(unittest.TestCase):
 
-    _test_dir_name = 'TEST DIR'
+    _tree = {'TEST FILE': None}
 
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        _create_dir(self._test_dir_name)
+    def test_rename_file_remove_spaces(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST FILE'])
+        self.assertEqual({'TEST_FILE': 'TEST FILE'}, tree)
+
+    def test_rename_file_convert_to_lowercase(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST FILE'],
+                                       is_to_lower=True)
+        self.assertEqual({'test_file': 'TEST FILE'}, tree)
+
+    def test_dry_run_does_not_modify_the_file(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST FILE'],
+                                       is_dry_run=True)
+        self.assertEqual({'TEST FILE': 'TEST FILE'}, tree)
 
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
+
+class TestRenameDirectory(unittest.TestCase):
+
+    _tree = {'TEST DIR': {}}
 
     def test_rename_directory_remove_spaces(self):
-        expected_name = self._test_dir_name.replace(' ', '_')
-        expected_path = os.path.join(TEST_DIR, expected_name)
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt "{self._test_dir_name}"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(expected_path))
-        _remove_dir(expected_path)
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR'])
+        self.assertEqual({'TEST_DIR': {}}, tree)
 
     def test_rename_directory_covert_to_lowercase(self):
-        expected_name = self._test_dir_name.replace(' ', '_').lower()
-        expected_path = os.path.join(TEST_DIR, expected_name)
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt -l "{self._test_dir_name}"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(expected_path))
-        _remove_dir(expected_path)
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR'],
+                                       is_to_lower=True)
+        self.assertEqual({'test_dir': {}}, tree)
 
     def test_dry_run_does_not_modify_the_dir(self):
-        expected_name = self._test_dir_name.replace(' ', '_')
-        original_path = os.path.join(TEST_DIR, self._test_dir_name)
-        expected_path = os.path.join(TEST_DIR, expected_name)
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(f'frmt -d "{self._test_dir_name}"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        self.assertEqual(True, os.path.exists(original_path))
-        self.assertEqual(False, os.path.exists(expected_path))
-        _remove_dir(original_path)
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR'],
+                                       is_dry_run=True)
+        self.assertEqual({'TEST DIR': {}}, tree)
 
 
 class TestRenameRecursiveFiles(unittest.TestCase):
@@ -267,132 +353,70 @@ class TestRenameRecursiveFiles(unittest.TestCase):
         }
     }
 
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        self._hashes_dict = _create_test_tree(self._tree)
-
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
-
     def test_recursive(self):
-        expected_tree = {
+        tree, session = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                             is_recursive=True)
+        self.assertEqual({
             'TEST_DIR_1': {
-                'TEST_FILE_1': None,
+                'TEST_FILE_1': 'TEST FILE 1',
                 'TEST_DIR_2': {
-                    'TEST_FILE_2': None,
+                    'TEST_FILE_2': 'TEST FILE 2',
                     'TEST_DIR_3': {
-                        'TEST_FILE_3': None,
+                        'TEST_FILE_3': 'TEST FILE 3',
                     }
                 }
             }
-        }
-        expected_renaming = {
-            'TEST_DIR_1': 'TEST DIR 1',
-            'TEST_FILE_1': 'TEST FILE 1',
-            'TEST_DIR_2': 'TEST DIR 2',
-            'TEST_FILE_2': 'TEST FILE 2',
-            'TEST_DIR_3': 'TEST DIR 3',
-            'TEST_FILE_3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -r "TEST DIR 1"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
+        }, tree)
+        self.assertEqual([], session.errors)
 
     def test_recursive_files_only(self):
-        expected_tree = {
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True, is_file_only=True)
+        self.assertEqual({
             'TEST DIR 1': {
-                'TEST_FILE_1': None,
+                'TEST_FILE_1': 'TEST FILE 1',
                 'TEST DIR 2': {
-                    'TEST_FILE_2': None,
+                    'TEST_FILE_2': 'TEST FILE 2',
                     'TEST DIR 3': {
-                        'TEST_FILE_3': None,
+                        'TEST_FILE_3': 'TEST FILE 3',
                     }
                 }
             }
-        }
-        expected_renaming = {
-            'TEST DIR_1': 'TEST DIR 1',
-            'TEST_FILE_1': 'TEST FILE 1',
-            'TEST DIR 2': 'TEST DIR 2',
-            'TEST_FILE_2': 'TEST FILE 2',
-            'TEST DIR 3': 'TEST DIR 3',
-            'TEST_FILE_3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run(
-            'frmt -r -f "TEST DIR 1"',
-            shell=True,
-            check=True,
-            env=self._env,
-            stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self,
-                              expected_tree,
-                              self._hashes_dict,
-                              expected_renaming,
-                              TEST_DIR,
-                              is_files_only=True)
+        }, tree)
 
 
 class TestRenameNumberedFiles(unittest.TestCase):
 
-    _tree = {
-        'TEST DIR 1': {
-            'TEST FILE D': None,
-            'TEST FILE A': None,
-            'TEST FILE 3': None,
-            'TEST FILE': None,
-            'TEST FILE ABC': None,
-        }
-    }
-
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
+    # Files are written in order, each a second newer than the one before,
+    # and numbered oldest first; targets come sorted as from a shell glob
+    def _process(self, tree):
+        targets = [os.path.join('TEST DIR 1', name)
+                   for name in sorted(tree['TEST DIR 1'])]
+        return _process_memory_tree(tree, targets, is_file_only=True,
+                                    name='sample')[0]
 
     def test_rename_numbered_files(self):
-        hashes_dict = _create_test_tree(self._tree)
-        expected_tree = {
+        tree = self._process({
             'TEST DIR 1': {
-                'sample_1': None,
-                'sample_2': None,
-                'sample_3': None,
-                'sample_4': None,
-                'sample_5': None,
+                'TEST FILE D': None,
+                'TEST FILE A': None,
+                'TEST FILE 3': None,
+                'TEST FILE': None,
+                'TEST FILE ABC': None,
             }
-        }
-        expected_renaming = {
-            'TEST DIR 1': 'TEST DIR 1',
-            'sample_1': 'TEST FILE D',
-            'sample_2': 'TEST FILE A',
-            'sample_3': 'TEST FILE 3',
-            'sample_4': 'TEST FILE',
-            'sample_5': 'TEST FILE ABC',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -f -n sample "TEST DIR 1"/*',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree, hashes_dict,
-                              expected_renaming, TEST_DIR, is_files_only=True)
+        })
+        self.assertEqual({
+            'TEST DIR 1': {
+                'sample_1': 'TEST FILE D',
+                'sample_2': 'TEST FILE A',
+                'sample_3': 'TEST FILE 3',
+                'sample_4': 'TEST FILE',
+                'sample_5': 'TEST FILE ABC',
+            }
+        }, tree)
 
     def test_rename_numbered_files_already_with_same_name_and_sequence(self):
-        tree = {
+        tree = self._process({
             'TEST DIR 1': {
                 'other file': None,
                 'sample_1': None,
@@ -400,34 +424,16 @@ class TestRenameNumberedFiles(unittest.TestCase):
                 'sample_3': None,
                 'sample_4': None,
             }
-        }
-        hashes_dict = _create_test_tree(tree)
-        expected_tree = {
+        })
+        self.assertEqual({
             'TEST DIR 1': {
-                'sample_1': None,
-                'sample_2': None,
-                'sample_3': None,
-                'sample_4': None,
-                'sample_5': None,
+                'sample_1': 'other file',
+                'sample_2': 'sample_1',
+                'sample_3': 'sample_2',
+                'sample_4': 'sample_3',
+                'sample_5': 'sample_4',
             }
-        }
-        expected_renaming = {
-            'TEST DIR 1': 'TEST DIR 1',
-            'sample_1': 'other file',
-            'sample_2': 'sample_1',
-            'sample_3': 'sample_2',
-            'sample_4': 'sample_3',
-            'sample_5': 'sample_4',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -f -n sample "TEST DIR 1"/*',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree, hashes_dict,
-                              expected_renaming, TEST_DIR, is_files_only=True)
+        }, tree)
 
 
 class TestExcludeDirectory(unittest.TestCase):
@@ -444,44 +450,22 @@ class TestExcludeDirectory(unittest.TestCase):
         }
     }
 
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        self._hashes_dict = _create_test_tree(self._tree)
-
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
-
     def test_recursive(self):
-        expected_tree = {
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True,
+                                       exclude_dirs=('TEST DIR 2',))
+        self.assertEqual({
             'TEST_DIR_1': {
-                'TEST_FILE_1': None,
+                'TEST_FILE_1': 'TEST FILE 1',
                 'TEST DIR 2': {
-                    'TEST FILE 2': None,
+                    'TEST FILE 2': 'TEST FILE 2',
                     'TEST DIR 3': {
-                        'TEST FILE 3': None,
+                        'TEST FILE 3': 'TEST FILE 3',
                     }
                 }
             }
-        }
-        expected_renaming = {
-            'TEST_DIR_1': 'TEST DIR 1',
-            'TEST_FILE_1': 'TEST FILE 1',
-            'TEST DIR 2': 'TEST DIR 2',
-            'TEST FILE 2': 'TEST FILE 2',
-            'TEST DIR 3': 'TEST DIR 3',
-            'TEST FILE 3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -r -e "TEST DIR 2" "TEST DIR 1"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
+        }, tree)
+
 
 class TestToCapitalize(unittest.TestCase):
 
@@ -497,46 +481,21 @@ class TestToCapitalize(unittest.TestCase):
         }
     }
 
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        self._hashes_dict = _create_test_tree(self._tree)
-
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
-
     def test_recursive(self):
-        expected_tree = {
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True,
+                                       is_to_capitalize=True)
+        self.assertEqual({
             'Test_Dir_1': {
-                'Test_File_1': None,
+                'Test_File_1': 'TEST FILE 1',
                 'Test_Dir_2': {
-                    'Test_File_2': None,
+                    'Test_File_2': 'TEST FILE 2',
                     'Test_Dir_3': {
-                        'Test_File_3': None,
+                        'Test_File_3': 'TEST FILE 3',
                     }
                 }
             }
-        }
-        expected_renaming = {
-            'Test_Dir_1': 'TEST DIR 1',
-            'Test_File_1': 'TEST FILE 1',
-            'Test_Dir_2': 'TEST DIR 2',
-            'Test_File_2': 'TEST FILE 2',
-            'Test_Dir_3': 'TEST DIR 3',
-            'Test_File_3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -r -l "TEST DIR 1"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
-
-
+        }, tree)
 
 
 class TestToLower(unittest.TestCase):
@@ -553,44 +512,20 @@ class TestToLower(unittest.TestCase):
         }
     }
 
-    def setUp(self):
-        _init_test_dir()
-        os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        self._hashes_dict = _create_test_tree(self._tree)
-
-    def tearDown(self):
-        _remove_dir(TEST_DIR)
-
     def test_recursive(self):
-        expected_tree = {
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True, is_to_lower=True)
+        self.assertEqual({
             'test_dir_1': {
-                'test_file_1': None,
+                'test_file_1': 'TEST FILE 1',
                 'test_dir_2': {
-                    'test_file_2': None,
+                    'test_file_2': 'TEST FILE 2',
                     'test_dir_3': {
-                        'test_file_3': None,
+                        'test_file_3': 'TEST FILE 3',
                     }
                 }
             }
-        }
-        expected_renaming = {
-            'test_dir_1': 'TEST DIR 1',
-            'test_file_1': 'TEST FILE 1',
-            'test_dir_2': 'TEST DIR 2',
-            'test_file_2': 'TEST FILE 2',
-            'test_dir_3': 'TEST DIR 3',
-            'test_file_3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -r -l "TEST DIR 1"',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
+        }, tree)
 
 
 class TestSubstitute(unittest.TestCase):
@@ -607,53 +542,443 @@ class TestSubstitute(unittest.TestCase):
         }
     }
 
+    def test_recursive(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True,
+                                       substitute='TEST/SAMPLE')
+        self.assertEqual({
+            'SAMPLE_DIR_1': {
+                'SAMPLE_FILE_1': 'TEST FILE 1',
+                'SAMPLE_DIR_2': {
+                    'SAMPLE_FILE_2': 'TEST FILE 2',
+                    'SAMPLE_DIR_3': {
+                        'SAMPLE_FILE_3': 'TEST FILE 3',
+                    }
+                }
+            }
+        }, tree)
+
+
+class TestRenamePP3FileInImages(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1.jpg': None,
+            'TEST FILE 2.jpg': None,
+            'TEST FILE 2.jpg.pp3': None,
+            'TEST FILE 3': None,
+        }
+    }
+
+    def test_recursive(self):
+        tree, _ = _process_memory_tree(
+            self._tree, ['TEST FILE 1.jpg', 'TEST FILE 2.jpg'],
+            cwd='/test/TEST DIR 1', name='sample')
+        self.assertEqual({
+            'TEST DIR 1': {
+                'sample_1.jpg': 'TEST FILE 1.jpg',
+                'sample_2.jpg': 'TEST FILE 2.jpg',
+                'sample_2.jpg.pp3': 'TEST FILE 2.jpg.pp3',
+                'TEST FILE 3': 'TEST FILE 3',
+            }
+        }, tree)
+
+
+class TestJournal(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
+            }
+        }
+    }
+
     def setUp(self):
         _init_test_dir()
         os.chdir(TEST_DIR)
         self._env = _update_format_env_variable()
         self._hashes_dict = _create_test_tree(self._tree)
+        self._journal = os.path.join(PWD, 'test_journal.jsonl')
+        self.addCleanup(lambda: os.path.exists(self._journal)
+                        and os.remove(self._journal))
 
     def tearDown(self):
         _remove_dir(TEST_DIR)
 
-    def test_recursive(self):
-        expected_tree = {
-            'SAMPLE_DIR_1': {
-                'SAMPLE_FILE_1': None,
-                'SAMPLE_DIR_2': {
-                    'SAMPLE_FILE_2': None,
-                    'SAMPLE_DIR_3': {
-                        'SAMPLE_FILE_3': None,
-                    }
-                }
+    def _run(self, options):
+        subprocess.run(f'frmt --journal {self._journal} {options}',
+                       shell=True,
+                       check=True,
+                       env=self._env,
+                       stdout=subprocess.DEVNULL)
+
+    def test_undo_restores_the_original_names(self):
+        hash_tree_before = _hashdir(TEST_DIR)
+        self._run('-r "TEST DIR 1"')
+        self.assertEqual(['TEST_DIR_1'], os.listdir(TEST_DIR))
+        self._run('--undo')
+        self.assertEqual(['TEST DIR 1'], os.listdir(TEST_DIR))
+        self.assertEqual(['TEST DIR 2', 'TEST FILE 1'],
+                         sorted(os.listdir('TEST DIR 1')))
+        self.assertEqual(['TEST FILE 2'],
+                         os.listdir(os.path.join('TEST DIR 1', 'TEST DIR 2')))
+        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
+
+    def test_undo_and_resume_are_not_dry_runs(self):
+        self._run('-r "TEST DIR 1"')
+        for options in ['--undo -d', '--resume -d "TEST_DIR_1"',
+                        f'--undo --plan-out {TEST_DIR}/plan.jsonl']:
+            result = subprocess.run(
+                f'frmt --journal {self._journal} {options}',
+                shell=True,
+                env=self._env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True)
+            self.assertEqual(2, result.returncode)
+            self.assertIn('cannot be used with --dry-run', result.stderr)
+        self.assertEqual(['TEST_DIR_1'], os.listdir(TEST_DIR))
+
+    def test_resume_finishes_pending_steps_and_skips_finished_dirs(self):
+        dir_1 = os.path.join(TEST_DIR, 'TEST DIR 1')
+        dir_2 = os.path.join(dir_1, 'TEST DIR 2')
+        stat = os.stat(dir_2)
+        with open(self._journal, 'w', encoding='utf-8') as journal:
+            journal.write(json.dumps(['F', stat.st_dev, stat.st_ino]) + '\n')
+            journal.write(json.dumps([
+                'P', 0, os.path.join(dir_1, 'TEST FILE 1'),
+                os.path.join(dir_1, 'TEST_FILE_1')]) + '\n')
+            journal.write('["D", 0')
+        self._run('--resume -r "TEST DIR 1"')
+        self.assertEqual(['TEST_DIR_2', 'TEST_FILE_1'],
+                         sorted(os.listdir('TEST_DIR_1')))
+        self.assertEqual(['TEST FILE 2'],
+                         os.listdir(os.path.join('TEST_DIR_1', 'TEST_DIR_2')))
+        self.assertEqual(self._hashes_dict['TEST FILE 1'],
+                         _hashfile(os.path.join('TEST_DIR_1', 'TEST_FILE_1')))
+
+
+class TestIncremental(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
             }
         }
-        expected_renaming = {
-            'SAMPLE_DIR_1': 'TEST DIR 1',
-            'SAMPLE_FILE_1': 'TEST FILE 1',
-            'SAMPLE_DIR_2': 'TEST DIR 2',
-            'SAMPLE_FILE_2': 'TEST FILE 2',
-            'SAMPLE_DIR_3': 'TEST DIR 3',
-            'SAMPLE_FILE_3': 'TEST FILE 3',
-        }
-        hash_tree_before = _hashdir(TEST_DIR)
-        subprocess.run('frmt -r -s TEST/SAMPLE "TEST DIR 1"',
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        self._env = _update_format_env_variable()
+        self._env['XDG_CACHE_HOME'] = os.path.join(PWD, 'test_cache')
+        self.addCleanup(_remove_dir, self._env['XDG_CACHE_HOME'])
+        _create_test_tree(self._tree)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _run(self, options):
+        subprocess.run(f'frmt {options}',
                        shell=True,
                        check=True,
                        env=self._env,
                        stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
 
+    def test_unchanged_dirs_are_not_listed_again(self):
+        self._run('-r -i "TEST DIR 1"')
+        dir_1 = os.path.join(TEST_DIR, 'TEST_DIR_1')
+        dir_2 = os.path.join(dir_1, 'TEST_DIR_2')
+        _create_file(os.path.join(dir_2, 'NEW FILE'))
+        # A rename hidden by restoring the mtime must go unnoticed
+        mtime_ns = os.stat(dir_1).st_mtime_ns
+        os.rename(os.path.join(dir_1, 'TEST_FILE_1'),
+                  os.path.join(dir_1, 'HIDDEN FILE'))
+        os.utime(dir_1, ns=(mtime_ns, mtime_ns))
+        self._run('-r -i "TEST_DIR_1"')
+        self.assertEqual(['NEW_FILE', 'TEST_FILE_2'],
+                         sorted(os.listdir(dir_2)))
+        self.assertEqual(['HIDDEN FILE', 'TEST_DIR_2'],
+                         sorted(os.listdir(dir_1)))
+        self._run('-r -l -i "TEST_DIR_1"')
+        self.assertEqual(['hidden_file', 'test_dir_2'],
+                         sorted(os.listdir('test_dir_1')))
+
+
+class TestLibraryApi(unittest.TestCase):
 
-class TestRenamePP3FileInImages(unittest.TestCase):
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
+            }
+        },
+        'TEST DIR 3': {
+            'TEST FILE 3': None,
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_test_tree(self._tree)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_plan_does_not_touch_the_tree(self):
+        options = frmt.Options(cwd=TEST_DIR, is_recursive=True)
+        tree_plan = frmt.plan(['TEST DIR 1'], options)
+        self.assertEqual(['TEST FILE 2', 'TEST FILE 1', 'TEST DIR 2',
+                          'TEST DIR 1'],
+                         [os.path.basename(move_.src)
+                          for move_ in tree_plan.moves])
+        self.assertEqual(['TEST DIR 1', 'TEST DIR 3'],
+                         sorted(os.listdir(TEST_DIR)))
+        result = frmt.apply(tree_plan)
+        self.assertEqual([], result.errors)
+        self.assertEqual(4, len(result.renamed))
+        self.assertEqual(['TEST_FILE_2'], os.listdir(
+            os.path.join(TEST_DIR, 'TEST_DIR_1', 'TEST_DIR_2')))
+
+    def test_runs_with_different_options_side_by_side(self):
+        lower = frmt.Options(cwd=TEST_DIR, is_recursive=True,
+                             is_to_lower=True)
+        capitalize = frmt.Options(cwd=TEST_DIR, is_recursive=True,
+                                  is_to_capitalize=True)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(
+                lambda args: frmt.apply(frmt.plan(*args)),
+                [(['TEST DIR 1'], lower), (['TEST DIR 3'], capitalize)]))
+        self.assertEqual([[], []], [result.errors for result in results])
+        self.assertEqual(['Test_Dir_3', 'test_dir_1'],
+                         sorted(os.listdir(TEST_DIR)))
+        self.assertEqual(['Test_File_3'],
+                         os.listdir(os.path.join(TEST_DIR, 'Test_Dir_3')))
+
+    def test_conflicts_are_returned(self):
+        _create_file(os.path.join('TEST DIR 3', 'TEST_FILE_3'))
+        options = frmt.Options(cwd=TEST_DIR)
+        result = frmt.apply(frmt.plan([os.path.join('TEST DIR 3',
+                                                    'TEST FILE 3')],
+                                      options))
+        self.assertEqual([], result.renamed)
+        self.assertEqual([errno.EEXIST],
+                         [error.errno for error in result.errors])
+
+
+class TestSavedPlan(unittest.TestCase):
 
     _tree = {
         'TEST DIR 1': {
-            'TEST FILE 1.jpg': None,
-            'TEST FILE 2.jpg': None,
-            'TEST FILE 2.jpg.pp3': None,
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
+            },
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_test_tree(self._tree)
+        self.plan_path = os.path.join(PWD, 'plan.jsonl')
+        self.addCleanup(os.remove, self.plan_path)
+        subprocess.run(['frmt', '-r', '--plan-out', self.plan_path,
+                        'TEST DIR 1'],
+                       check=True,
+                       env=_update_format_env_variable(),
+                       stdout=subprocess.DEVNULL)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _apply(self, status=0):
+        result = subprocess.run(['frmt', '--apply-plan', self.plan_path,
+                                 '--stats-json', 'stats.json'],
+                                env=_update_format_env_variable(),
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        self.assertEqual(status, result.returncode)
+        with open('stats.json', encoding='utf-8') as file:
+            return json.load(file)['counters']
+
+    def test_plan_is_applied_without_walking(self):
+        self.assertEqual(['TEST DIR 1'], os.listdir(TEST_DIR))
+        counters = self._apply()
+        self.assertEqual(['TEST_DIR_1', 'stats.json'],
+                         sorted(os.listdir(TEST_DIR)))
+        self.assertEqual(['TEST_DIR_2', 'TEST_FILE_1'],
+                         sorted(os.listdir('TEST_DIR_1')))
+        self.assertEqual(['TEST_FILE_2'],
+                         os.listdir(os.path.join('TEST_DIR_1',
+                                                 'TEST_DIR_2')))
+        self.assertNotIn('listings', counters)
+        self.assertEqual(4, counters['renames'])
+
+    def test_stale_plan_renames_nothing(self):
+        path = os.path.join('TEST DIR 1', 'TEST FILE 1')
+        os.utime(path, ns=(0, 0))
+        counters = self._apply(status=1)
+        self.assertNotIn('renames', counters)
+        self.assertEqual(['TEST DIR 2', 'TEST FILE 1'],
+                         sorted(os.listdir('TEST DIR 1')))
+
+    def test_malformed_plan_is_rejected(self):
+        with open(self.plan_path, encoding='utf-8') as file:
+            header, batch, move_ = file.read().splitlines()[:3]
+        for lines in ([header, move_], [header, batch, '["x", 1]'],
+                      [header, batch, move_[:move_.rindex(',')] + ']'],
+                      [header, batch,
+                       '["f", 1, "x", "file", null, 1, 2]'],
+                      [header, batch,
+                       '["f", "a", "x", "file", null, "1", 2]'],
+                      [header, '["B", "a", [1]]'],
+                      [header, '["B", "a", "b"]'],
+                      [header, '["B"]'], [header, '{}'], [header, '[]']):
+            with open(self.plan_path, 'w', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+            with self.assertRaises(ValueError):
+                frmt.read_plan(self.plan_path, frmt.Options(cwd=TEST_DIR))
+        result = subprocess.run(['frmt', '--apply-plan', self.plan_path],
+                                env=_update_format_env_variable(),
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                text=True)
+        self.assertEqual(1, result.returncode)
+        self.assertEqual(f'format: cannot read plan: {self.plan_path}:2:'
+                         ' not a plan record\n', result.stderr)
+        self.assertEqual(['TEST DIR 1'], os.listdir(TEST_DIR))
+
+
+class TestConcurrentApply(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
+                'TEST DIR 3': {
+                    'TEST FILE 3': None,
+                },
+            },
+            'TEST DIR 4': {
+                'TEST FILE 4': None,
+                'TEST FILE 5': None,
+            },
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _run(self, jobs):
+        _remove_dir(TEST_DIR)
+        _init_test_dir()
+        _create_test_tree(self._tree)
+        moves = []
+        move = frmt.move
+
+        def slow_move(src, dest):
+            sleep(randint(0, 5) / 1000)
+            move(src, dest)
+            moves.append(src)
+
+        options = frmt.Options(cwd=TEST_DIR, is_recursive=True, jobs=jobs,
+                               output='text')
+        output = io.StringIO()
+        with mock.patch.object(frmt, 'move', slow_move):
+            frmt.process(['TEST DIR 1'], frmt.Session(options, file=output))
+        return moves, output.getvalue()
+
+    def test_dirs_are_renamed_after_their_contents(self):
+        moves, _ = self._run(jobs=4)
+        self.assertEqual(9, len(moves))
+        for index, src in enumerate(moves):
+            self.assertEqual([], [later for later in moves[index + 1:]
+                                  if later.startswith(src + os.sep)])
+
+    def test_output_does_not_depend_on_jobs(self):
+        _, serial = self._run(jobs=1)
+        _, parallel = self._run(jobs=4)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(9, len(parallel.splitlines()))
+
+    def test_journal_and_dir_state_with_several_jobs(self):
+        # Directories are renamed by their parent's batch, which may run
+        # before the main thread records that they are finished
+        tree = {f'DIR {index}': {f'SUB {sub}': {'FILE A': None}
+                                 for sub in range(10)}
+                for index in range(30)}
+        file_system = _memory_tree({'TOP DIR': tree})
+        options = frmt.Options(cwd='/test', is_recursive=True, jobs=8)
+        session = frmt.Session(
+            options, journal=frmt.Journal(os.path.join(TEST_DIR, 'journal')),
+            dir_state=frmt.DirState(os.path.join(TEST_DIR, 'dirs.db'), ''))
+        with mock.patch.object(frmt, 'FS', file_system):
+            try:
+                frmt.process(['TOP DIR'], session)
+            finally:
+                session.journal.close()
+                session.dir_state.close(commit=True)
+        self.assertEqual([], session.errors)
+        self.assertEqual(['TOP_DIR'], file_system.listdir('/test'))
+        self.assertEqual(331, len(frmt.read_journal(
+            os.path.join(TEST_DIR, 'journal')).finished))
+
+    def test_unlisted_dirs_wait_for_the_batches_below_them(self):
+        # With dir_state, 'c x' is unchanged and so never listed, but its
+        # parent must not rename it before the batch of 'g' inside is done
+        file_system = _memory_tree({'p': {'c': {'g': {'file': None}}}})
+        options = frmt.Options(cwd='/test', is_recursive=True, jobs=4)
+        move = frmt.move
+
+        def slow_move(src, dest):
+            if os.path.basename(src) == 'new file':
+                sleep(0.05)
+            move(src, dest)
+
+        def run():
+            session = frmt.Session(options, dir_state=frmt.DirState(
+                os.path.join(TEST_DIR, 'dirs.db'), ''))
+            with mock.patch.object(frmt, 'FS', file_system), \
+                    mock.patch.object(frmt, 'move', slow_move):
+                try:
+                    frmt.process(['p'], session)
+                finally:
+                    session.dir_state.close(commit=True)
+            return session
+
+        run()
+        file_system.move('/test/p/c', '/test/p/c x')
+        file_system.write('/test/p/c x/g/new file')
+        # Its batch comes first and runs inline, so the pool has started
+        # its threads by the time those of 'g' and 'p' are submitted
+        file_system.write('/test/p/c x/g/h/x y')
+        session = run()
+        self.assertEqual([], session.errors)
+        self.assertEqual({'c_x': {'g': {'file': 'file', 'new_file': '',
+                                        'h': {'x_y': ''}}}},
+                         _read_memory_tree(file_system, '/test/p'))
+
+
+class TestTargetList(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST FILE 2': None,
+        },
+        'TEST DIR 2': {
             'TEST FILE 3': None,
         }
     }
@@ -661,38 +986,845 @@ class TestRenamePP3FileInImages(unittest.TestCase):
     def setUp(self):
         _init_test_dir()
         os.chdir(TEST_DIR)
-        self._env = _update_format_env_variable()
-        self._hashes_dict = _create_test_tree(self._tree)
+        _create_test_tree(self._tree)
 
     def tearDown(self):
         _remove_dir(TEST_DIR)
 
+    def _assert_files_renamed(self):
+        self.assertEqual(['TEST_FILE_1', 'TEST_FILE_2'],
+                         sorted(os.listdir('TEST DIR 1')))
+        self.assertEqual(['TEST_FILE_3'], os.listdir('TEST DIR 2'))
+
+    def test_nul_separated_targets_from_stdin(self):
+        subprocess.run('find . -type f -print0 | frmt --stdin -0',
+                       shell=True,
+                       check=True,
+                       env=_update_format_env_variable(),
+                       stdout=subprocess.DEVNULL)
+        self._assert_files_renamed()
+
+    def test_targets_from_file(self):
+        with open(os.path.join(PWD, 'targets.txt'), 'w',
+                  encoding='utf-8') as file:
+            file.write('TEST DIR 1/TEST FILE 1\nTEST DIR 1/TEST FILE 2\n'
+                       'TEST DIR 2/TEST FILE 3')
+        self.addCleanup(os.remove, os.path.join(PWD, 'targets.txt'))
+        subprocess.run(f'frmt --from-file "{PWD}/targets.txt"',
+                       shell=True,
+                       check=True,
+                       env=_update_format_env_variable(),
+                       stdout=subprocess.DEVNULL)
+        self._assert_files_renamed()
+
+    def test_missing_target_list_is_an_argument_error(self):
+        result = subprocess.run(['frmt', '--from-file',
+                                 os.path.join(TEST_DIR, 'missing.txt'),
+                                 'TEST DIR 1'],
+                                env=_update_format_env_variable(),
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                text=True)
+        self.assertEqual(2, result.returncode)
+        self.assertIn("can't open", result.stderr)
+        self.assertNotIn('Traceback', result.stderr)
+        self.assertIn('TEST DIR 1', os.listdir(TEST_DIR))
+
+    def test_each_directory_is_listed_once(self):
+        self.addCleanup(setattr, frmt, 'STATS', frmt.STATS)
+        frmt.STATS = frmt.Stats()
+        # Only images are looked up among their neighbours for sidecars
+        targets = [os.path.join('TEST DIR 1', 'IMG 1.jpg'),
+                   os.path.join('TEST DIR 2', 'IMG 2.jpg'),
+                   os.path.join('TEST DIR 1', 'IMG 3.jpg')]
+        for target in targets:
+            _create_file(target)
+        frmt.process(iter(targets), frmt.Session(frmt.Options()))
+        self.assertEqual(2, frmt.STATS.counters['listings'])
+        self.assertEqual(['IMG_2.jpg', 'TEST FILE 3'],
+                         sorted(os.listdir('TEST DIR 2')))
+
+    def test_numbering_runs_across_chunks(self):
+        file_system = _memory_tree({f'img{index}': None
+                                    for index in range(5)})
+        session = frmt.Session(frmt.Options(cwd='/test', name='sample'))
+        with mock.patch.object(frmt, 'FS', file_system), \
+                mock.patch.object(frmt, 'TARGETS_CHUNK_SIZE', 2):
+            frmt.process([f'img{index}' for index in range(5)], session)
+        self.assertEqual([], session.errors)
+        self.assertEqual([f'sample_{index}' for index in range(1, 6)],
+                         file_system.listdir('/test'))
+
+
+class TestStartup(unittest.TestCase):
+
+    _heavy_modules = ['PIL', 'sqlite3', 'concurrent.futures', 'ctypes']
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_file('TEST FILE')
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _loaded_modules(self, options):
+        code = ('import sys, format; format.main(); print(*[name for name in'
+                f' {self._heavy_modules} if name in sys.modules])')
+        env = os.environ.copy()
+        env['PYTHONPATH'] = PWD
+        output = subprocess.run([sys.executable, '-c', code, *options],
+                                check=True,
+                                env=env,
+                                stdout=subprocess.PIPE,
+                                text=True).stdout
+        return output.splitlines()[-1].split()
+
+    def test_dry_run_loads_no_heavy_module(self):
+        self.assertEqual([], self._loaded_modules(['-d', 'TEST FILE']))
+        self.assertEqual(['TEST FILE'], os.listdir(TEST_DIR))
+
+    def test_rename_only_loads_what_it_uses(self):
+        self.assertEqual(['ctypes'], self._loaded_modules(['TEST FILE']))
+        self.assertEqual(['TEST_FILE'], os.listdir(TEST_DIR))
+
+
+class TestStats(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'test_file_2': None,
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_test_tree(self._tree)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_counters_and_timers_are_collected(self):
+        self.addCleanup(setattr, frmt, 'STATS', frmt.STATS)
+        frmt.STATS = frmt.Stats()
+        options = frmt.Options(cwd=TEST_DIR, is_recursive=True)
+        frmt.process(['TEST DIR 1'], frmt.Session(options))
+        counters = frmt.STATS.counters
+        self.assertEqual(2, counters['renames'])
+        self.assertEqual(1, counters['no_ops'])
+        self.assertEqual(0, counters['failures'])
+        self.assertEqual(2, counters['files'])
+        self.assertEqual({'discover', 'plan', 'apply'},
+                         set(frmt.STATS.timers))
+
+    def test_stats_are_written_as_json(self):
+        subprocess.run('frmt --stats-json stats.json "TEST DIR 1"',
+                       shell=True,
+                       check=True,
+                       env=_update_format_env_variable(),
+                       stdout=subprocess.DEVNULL)
+        with open('stats.json', encoding='utf-8') as file:
+            report = json.load(file)
+        self.assertEqual(1, report['counters']['renames'])
+        self.assertIn('total', report['timers'])
+
+
+class TestOutput(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'IMG\t1 A.jpg': None,
+            'IMG\t1 A.jpg.xmp': None,
+            'img_2.jpg': None,
+            'IMG 3.jpg': None,
+            'IMG_3.jpg': None,
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_test_tree(self._tree)
+        self.directory = os.path.join(TEST_DIR, 'TEST DIR 1')
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _run(self, output, *options):
+        return subprocess.run(['frmt', '--output', output, *options,
+                               'TEST DIR 1'],
+                              check=True,
+                              env=_update_format_env_variable(),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              text=True).stdout
+
+    def test_jsonl_records_and_summary(self):
+        records = [json.loads(line)
+                   for line in self._run('jsonl', '-r').splitlines()]
+        self.assertEqual({'type': 'summary', 'renamed': 3, 'planned': 0,
+                          'conflict': 1, 'failed': 0}, records[-1])
+        self.assertIn({'type': 'item',
+                       'src': os.path.join(self.directory,
+                                           'IMG\t1 A.jpg.xmp'),
+                       'dest': os.path.join(self.directory,
+                                            'IMG\t1_A.jpg.xmp'),
+                       'kind': 'sidecar', 'status': 'renamed'}, records)
+        self.assertEqual(
+            [('dir', 'renamed'), ('file', 'conflict'), ('file', 'renamed'),
+             ('sidecar', 'renamed')],
+            sorted((record['kind'], record['status'])
+                   for record in records[:-1]))
+
+    def test_tsv_escapes_names(self):
+        lines = self._run('tsv', '-d', '-r').splitlines()
+        self.assertEqual('summary\trenamed=0\tplanned=3\tconflict=1'
+                         '\tfailed=0', lines[-1])
+        self.assertIn('\t'.join([
+            'planned', 'file',
+            os.path.join(self.directory, 'IMG\\t1 A.jpg'),
+            os.path.join(self.directory, 'IMG\\t1_A.jpg')]), lines)
+        self.assertEqual(5, len(lines))
+
+    def test_text_lists_sidecars(self):
+        lines = self._run('text', '-r').splitlines()
+        self.assertIn('IMG\t1 A.jpg.xmp'.ljust(50) + ' --> IMG\t1_A.jpg.xmp',
+                      lines)
+        self.assertEqual(3, len(lines))
+
+    def test_none_writes_nothing(self):
+        self.assertEqual('', self._run('none', '-r'))
+        self.assertEqual(['IMG\t1_A.jpg', 'IMG\t1_A.jpg.xmp', 'IMG 3.jpg',
+                          'IMG_3.jpg', 'img_2.jpg'],
+                         sorted(os.listdir('TEST_DIR_1')))
+
+
+class TestMemoryFileSystem(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'IMG 2.JPG': None,
+            'IMG 2.JPG.xmp': None,
+            'TEST DIR 2': {
+                'TEST FILE 3': None,
+            },
+        }
+    }
+
     def test_recursive(self):
-        expected_tree = {
+        tree, session = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                             is_recursive=True)
+        self.assertEqual({
+            'TEST_DIR_1': {
+                'TEST_FILE_1': 'TEST FILE 1',
+                'IMG_2.JPG': 'IMG 2.JPG',
+                'IMG_2.JPG.xmp': 'IMG 2.JPG.xmp',
+                'TEST_DIR_2': {
+                    'TEST_FILE_3': 'TEST FILE 3',
+                },
+            }
+        }, tree)
+        self.assertEqual([], session.errors)
+
+    def test_recursive_files_only_to_lower(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True, is_file_only=True,
+                                       is_to_lower=True)
+        self.assertEqual({
+            'TEST DIR 1': {
+                'test_file_1': 'TEST FILE 1',
+                'img_2.jpg': 'IMG 2.JPG',
+                'img_2.jpg.xmp': 'IMG 2.JPG.xmp',
+                'TEST DIR 2': {
+                    'test_file_3': 'TEST FILE 3',
+                },
+            }
+        }, tree)
+
+    def test_dry_run_changes_nothing(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1'],
+                                       is_recursive=True, is_dry_run=True)
+        self.assertEqual(_read_memory_tree(_memory_tree(self._tree)), tree)
+
+    def test_numbered_files_follow_their_dates(self):
+        # Written in this order, so each file is a second newer than the
+        # one before; the capture date of the JPEG comes first of all
+        tree = {
             'TEST DIR 1': {
-                'sample_1.jpg': None,
-                'sample_2.jpg': None,
-                'sample_2.jpg.pp3': None,
+                'other file': None,
+                'sample_1': None,
+                'sample_2': None,
+                'photo.jpg': _exif_jpeg('1960:01:01 00:00:00'),
+            }
+        }
+        targets = [os.path.join('TEST DIR 1', name)
+                   for name in tree['TEST DIR 1']]
+        tree, _ = _process_memory_tree(tree, targets, name='sample')
+        self.assertEqual(['sample_1.jpg', 'sample_2', 'sample_3',
+                          'sample_4'], sorted(tree['TEST DIR 1']))
+        self.assertEqual('other file', tree['TEST DIR 1']['sample_2'])
+        self.assertEqual('sample_2', tree['TEST DIR 1']['sample_4'])
+
+    def test_conflicts_are_left_alone(self):
+        tree, session = _process_memory_tree(
+            {'TEST FILE': None, 'TEST_FILE': None, 'OTHER FILE': None},
+            ['TEST FILE', 'TEST_FILE', 'OTHER FILE'])
+        self.assertEqual({'TEST FILE': 'TEST FILE', 'TEST_FILE': 'TEST_FILE',
+                          'OTHER_FILE': 'OTHER FILE'}, tree)
+        self.assertEqual([errno.EEXIST],
+                         [error.errno for error in session.errors])
+
+    def test_clock_moves_with_every_change(self):
+        file_system = frmt.MemoryFileSystem(clock_ns=0, tick_ns=5)
+        file_system.write('/a/b')
+        file_system.write('/a/c', mtime_ns=1)
+        self.assertEqual([25, 15, 1], [file_system.stat(path).st_mtime_ns
+                                       for path in ['/a', '/a/b', '/a/c']])
+        file_system.move('/a/b', '/a/d')
+        self.assertEqual(30, file_system.stat('/a').st_mtime_ns)
+        self.assertEqual(15, file_system.stat('/a/d').st_mtime_ns)
+        with self.assertRaises(frmt.MoveError):
+            file_system.move('/a/c', '/a/d')
+
+
+@unittest.skipUnless(os.path.exists('/proc/sys/fs/inotify'), 'needs inotify')
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        self._env = _update_format_env_variable()
+        _create_dir('INBOX')
+        self._watch = subprocess.Popen(
+            'exec frmt -r -w -s FILE.jpg/PHOTO.jpg INBOX',
+            shell=True,
+            env=self._env,
+            stdout=subprocess.DEVNULL)
+        sleep(0.5)
+
+    def tearDown(self):
+        self._watch.terminate()
+        self._watch.wait()
+        _remove_dir(TEST_DIR)
+
+    def _wait_for(self, expected):
+        for _ in range(50):
+            if sorted(os.listdir('INBOX')) == expected:
+                break
+            sleep(0.1)
+        self.assertEqual(expected, sorted(os.listdir('INBOX')))
+
+    def test_new_entries_are_formatted(self):
+        hashes_dict = _create_dirs_and_files_from_tree(
+            os.path.join(TEST_DIR, 'INBOX'), {'NEW DIR': {'A B': None}})
+        _create_file(os.path.join('INBOX', 'NEW FILE.jpg'))
+        _create_file(os.path.join('INBOX', 'NEW FILE.jpg.pp3'))
+        self._wait_for(['NEW_DIR', 'NEW_PHOTO.jpg', 'NEW_PHOTO.jpg.pp3'])
+        self.assertEqual(hashes_dict['A B'],
+                         _hashfile(os.path.join('INBOX', 'NEW_DIR', 'A_B')))
+
+    def test_late_sidecar_follows_its_image(self):
+        _create_file(os.path.join('INBOX', 'NEW FILE.jpg'))
+        self._wait_for(['NEW_PHOTO.jpg'])
+        _create_file(os.path.join('INBOX', 'NEW FILE.xmp'))
+        self._wait_for(['NEW_PHOTO.jpg', 'NEW_PHOTO.xmp'])
+
+
+class TestCompileTransform(unittest.TestCase):
+
+    def test_capitalize(self):
+        transform = frmt.compile_transform(False, True, '')
+        self.assertEqual('The_Lord_of_The_Rings',
+                         transform('the lord_of THE rings'))
+        self.assertEqual('B_Ab', transform('b ab'))
+
+    def test_lower_and_substitute(self):
+        transform = frmt.compile_transform(True, False, 'test/sample')
+        self.assertEqual('sample_dir_1', transform('TEST DIR 1'))
+
+    def test_rules_are_compiled_once_and_results_memoized(self):
+        transform = frmt.compile_transform(True, False, 'season/s')
+        self.assertIs(transform, frmt.compile_transform(True, False,
+                                                        'season/s'))
+        hits = transform.cache_info().hits
+        self.assertEqual('s_1', transform('Season 1'))
+        self.assertEqual('s_1', transform('Season 1'))
+        self.assertEqual(hits + 1, transform.cache_info().hits)
+
+
+class TestMove(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_move_renames_in_process(self):
+        expected_hash = _create_file('TEST FILE (1) & it\'s')
+        frmt.move('TEST FILE (1) & it\'s', 'TEST_FILE')
+        self.assertEqual(False, os.path.exists('TEST FILE (1) & it\'s'))
+        self.assertEqual(expected_hash, _hashfile('TEST_FILE'))
+
+    def test_move_does_not_replace_existing_dest(self):
+        src_hash = _create_file('TEST FILE 1')
+        dest_hash = _create_file('TEST FILE 2')
+        with self.assertRaises(frmt.MoveError) as context:
+            frmt.move('TEST FILE 1', 'TEST FILE 2')
+        self.assertEqual(errno.EEXIST, context.exception.errno)
+        self.assertEqual('TEST FILE 1', context.exception.filename)
+        self.assertEqual('TEST FILE 2', context.exception.filename2)
+        self.assertEqual(src_hash, _hashfile('TEST FILE 1'))
+        self.assertEqual(dest_hash, _hashfile('TEST FILE 2'))
+
+    def test_move_missing_src(self):
+        with self.assertRaises(frmt.MoveError) as context:
+            frmt.move('MISSING', 'TEST_FILE')
+        self.assertEqual(errno.ENOENT, context.exception.errno)
+
+
+class TestPlanRenames(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_no_op_moves_are_dropped(self):
+        _create_file('TEST_FILE')
+        plan = frmt.plan_renames([frmt.Move('TEST_FILE', 'TEST_FILE', 'file')])
+        self.assertEqual([], plan.moves)
+        self.assertEqual([], plan.steps)
+
+    def test_moves_get_their_directory_and_names(self):
+        _create_file('TEST FILE')
+        plan = frmt.plan_renames([frmt.Move(
+            os.path.join(TEST_DIR, 'TEST FILE'),
+            os.path.join(TEST_DIR, 'TEST_FILE'), 'file')])
+        self.assertEqual([(TEST_DIR, 'TEST FILE', 'TEST_FILE')],
+                         [(move.directory, move.name, move.new_name)
+                          for move in plan.moves])
+
+    def test_chain_is_applied_without_temporary_names(self):
+        hash_1 = _create_file('sample_1')
+        hash_2 = _create_file('sample_2')
+        plan = frmt.plan_renames([frmt.Move('sample_1', 'sample_2', 'file'),
+                                  frmt.Move('sample_2', 'sample_3', 'file')])
+        self.assertEqual([('sample_2', 'sample_3'), ('sample_1', 'sample_2')],
+                         [(src, dest) for src, dest, _ in plan.steps])
+        frmt.apply_plan(plan, frmt.Session(frmt.Options()))
+        self.assertEqual(hash_1, _hashfile('sample_2'))
+        self.assertEqual(hash_2, _hashfile('sample_3'))
+
+    def test_cycle_uses_one_temporary_name(self):
+        hash_a = _create_file('a')
+        hash_b = _create_file('b')
+        plan = frmt.plan_renames([frmt.Move('a', 'b', 'file'),
+                                  frmt.Move('b', 'a', 'file')])
+        self.assertEqual(3, len(plan.steps))
+        frmt.apply_plan(plan, frmt.Session(frmt.Options()))
+        self.assertEqual(hash_a, _hashfile('b'))
+        self.assertEqual(hash_b, _hashfile('a'))
+        self.assertEqual(['a', 'b'], sorted(os.listdir(TEST_DIR)))
+
+    def test_conflicts_are_not_applied(self):
+        hash_1 = _create_file('TEST FILE')
+        hash_2 = _create_file('TEST_FILE')
+        hash_3 = _create_file('OTHER FILE')
+        plan = frmt.plan_renames([
+            frmt.Move('TEST FILE', 'TEST_FILE', 'file'),
+            frmt.Move('OTHER FILE', 'OTHER_FILE', 'file'),
+            frmt.Move('OTHER_FILE', 'OTHER_FILE', 'file'),
+            frmt.Move('OTHER FILE', 'TEST FILE', 'file')])
+        self.assertEqual(['TEST FILE'],
+                         [error.filename for error in plan.conflicts])
+        self.assertEqual(errno.EEXIST, plan.conflicts[0].errno)
+        frmt.apply_plan(plan, frmt.Session(frmt.Options()))
+        self.assertEqual(hash_1, _hashfile('TEST FILE'))
+        self.assertEqual(hash_2, _hashfile('TEST_FILE'))
+        self.assertEqual(hash_3, _hashfile('OTHER_FILE'))
+
+
+class TestConflictPolicies(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST_FILE_1': None,
+            'OTHER FILE': None,
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _run(self, policy):
+        _create_test_tree(self._tree)
+        return subprocess.run(['frmt', '-r', '--on-conflict', policy,
+                               'TEST DIR 1'],
+                              check=True,
+                              env=_update_format_env_variable(),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              text=True).stdout
+
+    def test_abort_renames_nothing(self):
+        output = self._run('abort')
+        self.assertIn('Nothing renamed: there are conflicts.', output)
+        self.assertEqual(['TEST DIR 1'], os.listdir(TEST_DIR))
+        self.assertEqual(['OTHER FILE', 'TEST FILE 1', 'TEST_FILE_1'],
+                         sorted(os.listdir('TEST DIR 1')))
+
+    def test_skip_leaves_only_conflicts(self):
+        self._run('skip')
+        self.assertEqual(['OTHER_FILE', 'TEST FILE 1', 'TEST_FILE_1'],
+                         sorted(os.listdir('TEST_DIR_1')))
+
+    def test_suffix_finds_free_names(self):
+        for name in ['A B.jpg', 'A B.xmp', 'A-B.jpg', 'a_b.jpg', 'a_b_1.xmp']:
+            _create_file(name)
+        plan = frmt.plan_renames([
+            frmt.Move('A B.jpg', 'a_b.jpg', 'file', 'A B.jpg'),
+            frmt.Move('A B.xmp', 'a_b.xmp', 'sidecar', 'A B.jpg'),
+            frmt.Move('A-B.jpg', 'a_b.jpg', 'file')], policy='suffix')
+        self.assertEqual([], plan.conflicts)
+        self.assertEqual([('A B.jpg', 'a_b_2.jpg'), ('A B.xmp', 'a_b_2.xmp'),
+                          ('A-B.jpg', 'a_b_1.jpg')],
+                         [(move.src, move.dest) for move in plan.moves])
+
+    def test_blocks_run_down_a_chain(self):
+        # Only the last name is taken, which keeps every source in place
+        file_system = _memory_tree({f'{index}': None
+                                    for index in range(2001)})
+        moves = [frmt.Move(f'/test/{index}', f'/test/{index + 1}', 'file')
+                 for index in range(2000)]
+        with mock.patch.object(frmt, 'FS', file_system):
+            plan = frmt.plan_renames(moves)
+        self.assertEqual(2000, len(plan.conflicts))
+        self.assertEqual([], plan.steps)
+
+    def test_suffix_from_the_command_line(self):
+        self._run('suffix')
+        self.assertEqual(['OTHER_FILE', 'TEST_FILE_1', 'TEST_FILE_1_1'],
+                         sorted(os.listdir('TEST_DIR_1')))
+
+
+class TestSortFiles(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def _create_files_with_dates(self):
+        files = []
+        for index, timestamp in enumerate([500, 100, 400, 100, 300, 200]):
+            file_name = f'TEST FILE {index}'
+            _create_file(file_name)
+            os.utime(file_name, (timestamp, timestamp))
+            files.append(frmt.Entry('', file_name))
+        return files
+
+    def test_parallel_sort_matches_serial_sort(self):
+        files = self._create_files_with_dates()
+        serial = list(files)
+        frmt.sort_files(serial, frmt.Options(name='sample', jobs=1))
+        parallel = list(files)
+        frmt.sort_files(parallel, frmt.Options(name='sample', jobs=4))
+        self.assertEqual(['TEST FILE 1', 'TEST FILE 3', 'TEST FILE 5',
+                          'TEST FILE 4', 'TEST FILE 2', 'TEST FILE 0'],
+                         [entry.name for entry in serial])
+        self.assertEqual(serial, parallel)
+
+    def test_files_are_sorted_within_their_directory(self):
+        file_system = frmt.MemoryFileSystem()
+        for path, seconds in [('/b/3', 30), ('/a/2', 20), ('/b/1', 10),
+                              ('/a/4', 40), ('/b/0', 0)]:
+            file_system.write(path, mtime_ns=seconds * 10 ** 9)
+        files = [frmt.Entry(*os.path.split(path))
+                 for path in ['/b/3', '/a/2', '/b/1', '/a/4', '/b/0']]
+        with mock.patch.object(frmt, 'FS', file_system):
+            frmt.sort_files(files, frmt.Options(name='sample', jobs=1))
+        self.assertEqual(['/b/0', '/b/1', '/b/3', '/a/2', '/a/4'],
+                         [entry.path for entry in files])
+
+
+class TestReadExifDate(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_jpeg_little_and_big_endian(self):
+        _write_bytes('ii.jpg', _exif_jpeg('2021:03:04 05:06:07', '<'))
+        _write_bytes('mm.jpg', _exif_jpeg('2020:01:02 03:04:05', '>'))
+        self.assertEqual(datetime(2021, 3, 4, 5, 6, 7),
+                         frmt.read_exif_date('ii.jpg'))
+        self.assertEqual(datetime(2020, 1, 2, 3, 4, 5),
+                         frmt.read_exif_date('mm.jpg'))
+
+    def test_tiff(self):
+        _write_bytes('image.dng', _exif_tiff('2019:12:31 23:59:58', '>'))
+        self.assertEqual(datetime(2019, 12, 31, 23, 59, 58),
+                         frmt.read_exif_date('image.dng'))
+
+    def test_matches_pillow(self):
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+        exif = Image.Exif()
+        exif.get_ifd(0x8769)[0x9003] = '2018:07:08 09:10:11'
+        Image.new('RGB', (8, 8)).save('pillow.jpg', exif=exif)
+        self.assertEqual(datetime(2018, 7, 8, 9, 10, 11),
+                         frmt.read_exif_date('pillow.jpg'))
+
+    def test_non_image_is_not_opened_with_pillow(self):
+        _create_file('TEST FILE')
+        os.utime('TEST FILE', (1000, 1000))
+        with mock.patch.object(frmt, '_read_exif_date_with_pillow') as pillow:
+            date = frmt.get_date_taken('TEST FILE')
+        pillow.assert_not_called()
+        self.assertEqual(datetime.fromtimestamp(1000), date)
+
+    def test_unparsable_image_falls_back_to_pillow(self):
+        _write_bytes('broken.jpg', b'\xff\xd8\x00\x00')
+        with mock.patch.object(frmt, '_read_exif_date_with_pillow',
+                               return_value=datetime(2000, 1, 1)) as pillow:
+            date = frmt.get_date_taken('broken.jpg')
+        pillow.assert_called_once_with('broken.jpg')
+        self.assertEqual(datetime(2000, 1, 1), date)
+
+
+class TestDateCache(unittest.TestCase):
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        self.addCleanup(setattr, frmt, 'DATE_CACHE_SIZE',
+                        frmt.DATE_CACHE_SIZE)
+        self._options = frmt.Options(
+            date_cache=os.path.join(TEST_DIR, 'cache', 'dates.db'))
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_rerun_does_not_read_unchanged_files(self):
+        _write_bytes('a.jpg', _exif_jpeg('2021:03:04 05:06:07'))
+        _create_file('TEST FILE')
+        expected = frmt.get_dates_taken(['a.jpg', 'TEST FILE'], self._options)
+        with mock.patch.object(frmt, 'read_exif_date') as read_exif_date:
+            dates = frmt.get_dates_taken(['a.jpg', 'TEST FILE'],
+                                         self._options)
+        read_exif_date.assert_not_called()
+        self.assertEqual(expected, dates)
+        self.assertEqual(datetime(2021, 3, 4, 5, 6, 7), dates[0])
+
+    def test_modified_file_is_read_again(self):
+        _write_bytes('a.jpg', _exif_jpeg('2021:03:04 05:06:07'))
+        frmt.get_dates_taken(['a.jpg'], self._options)
+        _write_bytes('a.jpg', _exif_jpeg('2022:03:04 05:06:07'))
+        os.utime('a.jpg', ns=(1, 1))
+        self.assertEqual([datetime(2022, 3, 4, 5, 6, 7)],
+                         frmt.get_dates_taken(['a.jpg'], self._options))
+
+    def test_cache_is_bounded(self):
+        frmt.DATE_CACHE_SIZE = 2
+        for index in range(3):
+            _create_file(f'TEST FILE {index}')
+        frmt.get_dates_taken([f'TEST FILE {index}' for index in range(3)],
+                             self._options)
+        with frmt.DateCache(self._options.date_cache, 2) as cache:
+            hits = cache.get([frmt.DateCache.key(os.stat(f'TEST FILE {index}'))
+                              for index in range(3)])
+        self.assertEqual(2, len([date for date in hits if date is not None]))
+
+    def test_run_opens_the_cache_once(self):
+        for directory in ['A', 'B']:
+            os.mkdir(directory)
+            _create_file(os.path.join(directory, 'TEST FILE'))
+        opened = []
+
+        class CountingCache(frmt.DateCache):
+
+            def __init__(self, *args):
+                super().__init__(*args)
+                opened.append(self)
+
+        session = frmt.Session(self._options._replace(cwd=TEST_DIR,
+                                                      name='sample'))
+        with mock.patch.object(frmt, 'DateCache', CountingCache):
+            frmt.process(iter([os.path.join('A', 'TEST FILE'),
+                               os.path.join('B', 'TEST FILE')]), session)
+            session.close()
+        self.assertEqual(1, len(opened))
+        self.assertEqual(['sample_1'], os.listdir('B'))
+
+
+class TestWalk(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1': None,
+            'TEST DIR 2': {
+                'TEST FILE 2': None,
+            },
+            'EXCLUDED': {
                 'TEST FILE 3': None,
+            },
+        }
+    }
+
+    def setUp(self):
+        _init_test_dir()
+        os.chdir(TEST_DIR)
+        _create_test_tree(self._tree)
+
+    def tearDown(self):
+        _remove_dir(TEST_DIR)
+
+    def test_walk_is_bottom_up_and_prunes_excluded_dirs(self):
+        os.symlink(os.path.join(TEST_DIR, 'TEST DIR 1'),
+                   os.path.join(TEST_DIR, 'TEST DIR 1', 'LINK'))
+        walked = [(os.path.relpath(root, TEST_DIR),
+                   sorted(entry.name for entry in dirs),
+                   sorted(entry.name for entry in files))
+                  for root, dirs, files in frmt.walk(
+                      os.path.join(TEST_DIR, 'TEST DIR 1'),
+                      frozenset(['EXCLUDED']))]
+        self.assertEqual([
+            (os.path.join('TEST DIR 1', 'TEST DIR 2'), [], ['TEST FILE 2']),
+            ('TEST DIR 1', ['LINK', 'TEST DIR 2'], ['TEST FILE 1']),
+        ], walked)
+
+    def test_batches_are_yielded_one_directory_at_a_time(self):
+        session = frmt.Session(frmt.Options(cwd=TEST_DIR, is_recursive=True))
+        batches = [(sorted(os.path.relpath(path, TEST_DIR) for path in dirs),
+                    sorted(os.path.relpath(entry.path, TEST_DIR)
+                           for entry in files))
+                   for _, dirs, files, _ in frmt.find_batches(['TEST DIR 1'],
+                                                              session)]
+        self.assertEqual([
+            ([], [os.path.join('TEST DIR 1', 'EXCLUDED', 'TEST FILE 3')]),
+            ([], [os.path.join('TEST DIR 1', 'TEST DIR 2', 'TEST FILE 2')]),
+            ([os.path.join('TEST DIR 1', 'EXCLUDED'),
+              os.path.join('TEST DIR 1', 'TEST DIR 2')],
+             [os.path.join('TEST DIR 1', 'TEST FILE 1')]),
+            (['TEST DIR 1'], []),
+        ], sorted(batches[:2]) + batches[2:])
+
+
+class TestRenamePP3FileRecursive(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'TEST FILE 1.JPG': None,
+            'TEST FILE 1.JPG.pp3': None,
+            'TEST DIR 2': {
+                'TEST FILE 2.jpg': None,
+                'TEST FILE 2.jpg.pp3': None,
+                'TEST FILE 3.jpg.pp3': None,
             }
         }
-        expected_renaming = {
-            'TEST DIR 1': 'TEST DIR 1',
-            'sample_1.jpg': 'TEST FILE 1.jpg',
-            'sample_2.jpg': 'TEST FILE 2.jpg',
-            'sample_2.jpg.pp3': 'TEST FILE 2.jpg.pp3',
-            'TEST FILE 3': 'TEST FILE 3',
+    }
+
+    def test_recursive(self):
+        tree, _ = _process_memory_tree(self._tree, ['TEST DIR 1/'],
+                                       is_recursive=True, is_to_lower=True)
+        self.assertEqual({
+            'test_dir_1': {
+                'test_file_1.jpg': 'TEST FILE 1.JPG',
+                'test_file_1.jpg.pp3': 'TEST FILE 1.JPG.pp3',
+                'test_dir_2': {
+                    'test_file_2.jpg': 'TEST FILE 2.jpg',
+                    'test_file_2.jpg.pp3': 'TEST FILE 2.jpg.pp3',
+                    'test_file_3.jpg.pp3': 'TEST FILE 3.jpg.pp3',
+                }
+            }
+        }, tree)
+
+
+class TestRenameSidecars(unittest.TestCase):
+
+    _tree = {
+        'TEST DIR 1': {
+            'IMG 1.HEIC': None,
+            'IMG 1.AAE': None,
+            'IMG 1.HEIC.json': None,
+            'IMG 2.jpg': None,
+            'IMG 2.xmp': None,
+            'IMG 3.mov': None,
+            'IMG 3.THM': None,
+            'NOTES.json': None,
         }
-        hash_tree_before = _hashdir(TEST_DIR)
-        os.chdir('TEST DIR 1')
-        subprocess.run('frmt -n sample *.jpg',
-                       shell=True,
-                       check=True,
-                       env=self._env,
-                       stdout=subprocess.DEVNULL)
-        self.assertEqual(hash_tree_before, _hashdir(TEST_DIR))
-        _assert_tree_renaming(self, expected_tree,
-                              self._hashes_dict, expected_renaming, TEST_DIR)
+    }
+
+    def _process(self, tree, **options):
+        # As frmt * would be run from within the directory
+        return _process_memory_tree(tree, sorted(tree['TEST DIR 1']),
+                                    cwd='/test/TEST DIR 1', is_file_only=True,
+                                    **options)[0]['TEST DIR 1']
+
+    def test_sidecars_follow_their_file(self):
+        self.assertEqual({
+            'sample_1.heic': 'IMG 1.HEIC',
+            'sample_1.AAE': 'IMG 1.AAE',
+            'sample_1.heic.json': 'IMG 1.HEIC.json',
+            'sample_2.jpg': 'IMG 2.jpg',
+            'sample_2.xmp': 'IMG 2.xmp',
+            'sample_3.mov': 'IMG 3.mov',
+            'sample_3.THM': 'IMG 3.THM',
+            'sample_4.json': 'NOTES.json',
+        }, self._process(self._tree, name='sample'))
+
+    def test_only_configured_sidecars_are_paired(self):
+        self.assertEqual({
+            'img_1.heic': 'IMG 1.HEIC',
+            'img_1.aae': 'IMG 1.AAE',
+            'img_1.heic.json': 'IMG 1.HEIC.json',
+            'img_2.jpg': 'IMG 2.jpg',
+            'img_2.xmp': 'IMG 2.xmp',
+            'img_3.mov': 'IMG 3.mov',
+            'img_3.thm': 'IMG 3.THM',
+            'notes.json': 'NOTES.json',
+        }, self._process(self._tree, is_to_lower=True,
+                         sidecar_extensions=('xmp',)))
+
+    def test_sidecar_extensions_follow_the_case_rules(self):
+        tree = {'TEST DIR 1': {'IMG 1.JPG': None, 'IMG 1.XMP': None,
+                               'IMG 1.JPG.PP3': None, 'Lone.XMP': None}}
+        self.assertEqual({
+            'img_1.jpg': 'IMG 1.JPG',
+            'img_1.xmp': 'IMG 1.XMP',
+            'img_1.jpg.pp3': 'IMG 1.JPG.PP3',
+            'lone.xmp': 'Lone.XMP',
+        }, self._process(tree, is_to_lower=True))
+        self.assertEqual({
+            'Img_1.jpg': 'IMG 1.JPG',
+            'Img_1.xmp': 'IMG 1.XMP',
+            'Img_1.jpg.pp3': 'IMG 1.JPG.PP3',
+            'Lone.xmp': 'Lone.XMP',
+        }, self._process(tree, is_to_capitalize=True))
+
+    def test_sidecar_conflict_blocks_the_whole_group(self):
+        tree = {'TEST DIR 1': {**self._tree['TEST DIR 1'],
+                               'img_2.xmp': None}}
+        names = self._process(tree, is_to_lower=True)
+        self.assertIn('IMG 2.jpg', names)
+        self.assertIn('IMG 2.xmp', names)
+        self.assertIn('img_1.heic', names)
 
 
 if __name__ == '__main__':